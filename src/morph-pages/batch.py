@@ -0,0 +1,412 @@
+"""Site-wide morphing.
+
+Functions of this script morph all the pages of a site, given as a
+directory or as a manifest (a file listing one page per line), in a
+pool of processes. The sampler is loaded once per process, and pages
+are handed to the processes in chunks.
+
+In incremental mode, the state of the files each page was morphed
+from, and the files it was morphed into, are kept in a manifest in
+the output directory (see MorphManifest). Only the pages whose HTML
+or objects changed are morphed again, and the outputs that no page
+uses any more (e.g., variants of an object at its previous size)
+are deleted.
+"""
+import os
+import json
+import time
+import logging
+import multiprocessing
+import page
+import morphing
+import sampling
+from file_utils import cached_digest, file_signature, make_path
+
+HTML_EXTENSIONS = ('.html', '.htm')
+# Name of the manifest of incremental runs, in the output directory.
+MANIFEST = '.alpaca-manifest.json'
+MANIFEST_VERSION = 2
+
+logger = logging.getLogger(__name__)
+
+# Sampler of the current process, and the arguments it was loaded
+# from (see _init_worker).
+_sampler = None
+_distribution = None
+
+class MorphManifest(object):
+    """Files each morphed page was morphed from.
+
+    For each page (by path relative to the site), the manifest keeps
+    the mtime, size and digest of its HTML file and of its objects
+    (None for referenced files that did not exist), the files it was
+    morphed into (relative to the output directory), and the settings
+    of the run. A page needs to be morphed again if the settings
+    changed, or if any of its files changed: a file whose mtime
+    changed but not its size and digest is not considered changed.
+
+    Parameters
+    ----------
+    fname : str
+        File storing the manifest.
+    settings : dict
+        Settings of the run (method, parameters, ...).
+    """
+
+    def __init__(self, fname, settings):
+        self.fname = fname
+        # As read back from JSON.
+        self.settings = json.loads(json.dumps(settings))
+        self.pages = {}
+        if os.path.exists(fname):
+            with open(fname, 'r') as f:
+                content = json.load(f)
+            if content.get('version') == MANIFEST_VERSION and \
+                    content.get('settings') == self.settings:
+                self.pages = content['pages']
+
+    def is_current(self, key):
+        """Returns True if page key was morphed with the current
+        settings from the current files.
+        """
+        entry = self.pages.get(key)
+        if entry is None or entry['files'] is None:
+            return False
+        for fname, state in entry['files'].items():
+            if not _same_file(fname, state):
+                return False
+
+        return True
+
+    def update(self, key, files, outputs):
+        """Records the files (see file_states) page key was morphed
+        from, and the outputs it was morphed into. With files None,
+        the page is morphed again next time.
+        """
+        self.pages[key] = {'files': files, 'outputs': outputs}
+
+    def invalidate(self, key):
+        """Marks page key to be morphed again, keeping its outputs.
+        """
+        entry = self.pages.get(key)
+        if entry is not None:
+            entry['files'] = None
+
+    def remove(self, key):
+        self.pages.pop(key, None)
+
+    def outputs(self):
+        """Returns the outputs of all the pages.
+        """
+        outputs = set()
+        for entry in self.pages.values():
+            outputs.update(entry['outputs'])
+
+        return outputs
+
+    def sources(self):
+        """Returns the files all the pages were morphed from.
+        """
+        sources = set()
+        for entry in self.pages.values():
+            sources.update(entry['files'] or ())
+
+        return sources
+
+    def save(self):
+        """Writes the manifest (atomically).
+        """
+        make_path(self.fname)
+        tmp = self.fname + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION,
+                       'settings': self.settings,
+                       'pages': self.pages}, f)
+        os.rename(tmp, self.fname)
+
+def file_states(signature):
+    """Returns {file: [mtime, size, digest]} (None for missing files)
+    from a page signature (see page.Page.signature).
+    """
+    files = {}
+    for fname, stat in signature:
+        if stat is None:
+            files[fname] = None
+            continue
+        digest = cached_digest(fname, stat)
+        # If the file changed after the page was parsed, the digest
+        # is not the one of the morphed content.
+        if file_signature(fname) != stat:
+            digest = None
+        files[fname] = [stat[0], stat[1], digest]
+
+    return files
+
+def find_pages(src):
+    """Returns the HTML files in directory src and its subdirectories.
+    """
+    pages = []
+    for dirpath, dirnames, filenames in os.walk(src):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in HTML_EXTENSIONS:
+                pages.append(os.path.join(dirpath, name))
+
+    return pages
+
+def read_manifest(fname, src):
+    """Returns the pages listed in manifest fname, one per line.
+
+    Relative paths are relative to src. Empty lines and lines
+    starting with # are ignored.
+    """
+    pages = []
+    with open(fname, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                pages.append(os.path.join(src, line))
+
+    return pages
+
+def morph_site(pages, src, dst, method, params, distribution=None,
+               processes=1, chunksize=8, workers=1, variants=True,
+               padding_pool=None, incremental=False):
+    """Morphs pages of the site in directory src into directory dst.
+
+    Each page is put into the directory of dst corresponding to its
+    directory in src. Padding objects are named after the page, so
+    that pages in the same directory do not overwrite each other's.
+    Objects are morphed into content-addressed variants (see
+    morphing.plan_morph) unless variants is False: an object shared
+    by many pages is then written once per target size.
+
+    Parameters
+    ----------
+    pages : list of str
+        HTML files of the pages to morph.
+    src : str
+        Directory of the site (document root).
+    dst : str
+        Output directory.
+    method : str
+        Either 'distribution' or 'deterministic'.
+    params : dict
+        Parameters of the method: max_attempts, and S, L and max_S
+        for 'deterministic'.
+    distribution : tuple (Default: None)
+        Arguments of sampling.make_sampler, for 'distribution'.
+    processes : int (Default: 1)
+        Number of pages morphed in parallel.
+    chunksize : int (Default: 8)
+        Number of pages handed to a process at once.
+    workers : int (Default: 1)
+        Number of objects of a page morphed in parallel (threads).
+    variants : bool (Default: True)
+        Morph objects into content-addressed variants.
+    padding_pool : str (Default: None)
+        Directory of a pool of padding blobs (see
+        morph_utils.create_object).
+    incremental : bool (Default: False)
+        Only morph the pages that changed since the previous
+        incremental run (see MorphManifest), and delete the outputs
+        that no page uses any more. The outputs of the previous runs
+        are assumed to be untouched.
+
+    Returns
+    -------
+    results : list of dict
+        Result of each page: page, ok, skipped (unchanged page),
+        error, seconds and sources (the objects it morphed in
+        place, rather than into variants). Morphed pages are in
+        order of completion.
+    """
+    settings = {'src': src, 'dst': dst, 'method': method, 'params': params,
+                'distribution': distribution, 'variants': variants,
+                'padding_pool': padding_pool}
+    results = []
+    manifest = None
+    if incremental:
+        manifest = MorphManifest(os.path.join(dst, MANIFEST), settings)
+        previous = manifest.outputs()
+        keys = set(os.path.relpath(fname, src) for fname in pages)
+        for key in list(manifest.pages):
+            if key not in keys:
+                manifest.remove(key)
+        changed = []
+        for fname in pages:
+            if manifest.is_current(os.path.relpath(fname, src)):
+                results.append({'page': fname, 'ok': True, 'skipped': True,
+                                'error': None, 'seconds': 0, 'sources': []})
+            else:
+                changed.append(fname)
+        pages = changed
+
+    options = dict(settings, workers=workers, incremental=incremental)
+    jobs = [(fname, options) for fname in pages]
+    if processes <= 1 or len(jobs) <= 1:
+        if jobs:
+            _init_worker(distribution)
+        results += [morph_one(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (distribution,))
+        try:
+            results += pool.imap_unordered(morph_one, jobs, chunksize)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+    if manifest is not None:
+        for r in results:
+            key = os.path.relpath(r['page'], src)
+            if not r['ok']:
+                # Its previous outputs may still be served.
+                manifest.invalidate(key)
+            elif not r['skipped']:
+                manifest.update(key, r['files'], r['outputs'])
+        manifest.save()
+        _remove_outputs(dst, previous - manifest.outputs(),
+                        manifest.sources())
+
+    return results
+
+def watch(find, src, dst, method, params, distribution=None, interval=2,
+          **kwargs):
+    """Morphs the pages of a site incrementally every interval seconds,
+    forever.
+
+    Changes are detected by scanning the files (see MorphManifest):
+    a page that did not change costs a stat() per file.
+
+    Parameters
+    ----------
+    find : function
+        Returns the pages to morph (e.g., lambda: find_pages(src)).
+    interval : float (Default: 2)
+        Seconds between two scans.
+
+    Other parameters are the ones of morph_site.
+    """
+    while True:
+        start = time.time()
+        results = morph_site(find(), src, dst, method, params, distribution,
+                             incremental=True, **kwargs)
+        if [r for r in results if not r['skipped']]:
+            report(results, time.time() - start)
+        time.sleep(interval)
+
+def morph_one(job):
+    """Morphs one page; errors are reported rather than raised.
+    """
+    fname, options = job
+    src = options['src']
+    params = options['params']
+    variants = options['variants']
+    outdir = os.path.join(options['dst'],
+                          os.path.relpath(os.path.dirname(fname), src))
+    name = os.path.splitext(os.path.basename(fname))[0]
+    max_attempts = params.get('max_attempts', 100)
+    start = time.time()
+    try:
+        # Files are recorded as they were before morphing: if they
+        # change meanwhile, the page is morphed again next time.
+        signature = page.cached_page(fname, src).signature()
+        if options['method'] == 'distribution':
+            plan = morphing.plan_page_distribution(fname, _sampler,
+                                                   max_attempts, root=src,
+                                                   padding_name=name,
+                                                   variants=variants)
+        elif options['method'] == 'deterministic':
+            plan = morphing.plan_page_deterministic(fname, params['S'],
+                                                    params['L'],
+                                                    params['max_S'],
+                                                    max_attempts, root=src,
+                                                    padding_name=name,
+                                                    variants=variants)
+        else:
+            raise Exception("{} not recognised.".format(options['method']))
+        morphing.execute_plan(plan, outdir, options['workers'],
+                              padding_pool=options['padding_pool'])
+    except Exception as e:
+        return {'page': fname, 'ok': False, 'skipped': False,
+                'error': str(e), 'seconds': time.time() - start,
+                'sources': []}
+
+    inplace = [source for source, variant in zip(plan.sources, plan.variants)
+               if not variant]
+    result = {'page': fname, 'ok': True, 'skipped': False, 'error': None,
+              'seconds': time.time() - start, 'sources': inplace}
+    if options['incremental']:
+        result['files'] = file_states(signature)
+        outputs = [os.path.basename(fname)] + list(plan.paths) + \
+                  plan.padding_paths()
+        result['outputs'] = sorted(set(
+            os.path.normpath(os.path.relpath(os.path.join(outdir, path),
+                                             options['dst']))
+            for path in outputs))
+
+    return result
+
+def report(results, seconds):
+    """Logs the result of each morphed page, and a summary.
+    """
+    skipped = [r for r in results if r['skipped']]
+    failed = [r for r in results if not r['ok']]
+    morphed = {}
+    for r in results:
+        if r['skipped']:
+            continue
+        if r['ok']:
+            logger.info('OK   %s (%.3fs)', r['page'], r['seconds'])
+        else:
+            logger.warning('FAIL %s (%.3fs): %s', r['page'], r['seconds'],
+                           r['error'])
+        for source in r['sources']:
+            morphed[source] = morphed.get(source, 0) + 1
+    shared = len([s for s in morphed if morphed[s] > 1])
+    done = len(results) - len(skipped)
+
+    logger.info('%d pages morphed, %d failed, in %.2fs (%.1f pages/s).',
+                done - len(failed), len(failed), seconds,
+                done / seconds if seconds > 0 else 0)
+    if skipped:
+        logger.info('%d pages unchanged.', len(skipped))
+    if shared:
+        logger.warning('%d objects are morphed in place by several pages: '
+                       'each of them has the size of its last morph.', shared)
+
+def _remove_outputs(dst, outputs, sources):
+    """Deletes outputs (relative to dst), except the files pages are
+    morphed from (if dst is the site itself).
+    """
+    sources = set(os.path.realpath(x) for x in sources)
+    for path in sorted(outputs):
+        fname = os.path.join(dst, path)
+        if os.path.realpath(fname) in sources or not os.path.isfile(fname):
+            continue
+        logger.debug('Removing %s', fname)
+        os.remove(fname)
+
+def _same_file(fname, state):
+    """Returns True if file fname is in state [mtime, size, digest]
+    (None: missing).
+    """
+    stat = file_signature(fname)
+    if stat is None or state is None:
+        return stat is None and state is None
+    mtime, size, digest = state
+    if stat[1] != size:
+        return False
+
+    return stat[0] == mtime or cached_digest(fname, stat) == digest
+
+def _init_worker(distribution):
+    """Loads the sampler of the current process, unless it is
+    already loaded from the same distribution.
+    """
+    global _sampler, _distribution
+    if distribution is not None and (_sampler is None or
+                                     distribution != _distribution):
+        _sampler = sampling.make_sampler(*distribution)
+        _distribution = distribution
@@ -0,0 +1,431 @@
+"""Benchmarks.
+
+Generates a synthetic site (pages referencing PNG, JPEG, CSS, SVG
+and JS objects of random sizes) and synthetic distributions, and
+times sampling, parsing, padding, size matching and end-to-end
+morphing with P-ALPaCA and D-ALPaCA, as well as the start-up time of
+each method of ssd.py.
+
+For each benchmark, the latency percentiles (in seconds), the
+throughput (items per second) and the peak RSS of the process so far
+are reported; the results can be written as JSON to track
+regressions:
+
+    python benchmark.py --pages 20 --objects 30 --output results.json
+"""
+import os
+import json
+import time
+import sys
+import shutil
+import struct
+import subprocess
+import resource
+import tempfile
+import zlib
+import numpy as np
+import page
+import morphing
+import sampling
+from argparse import ArgumentParser
+from kde_utils import FlatKDE, save_kde
+from morph_utils import PADDERS, padded_parts, write_parts
+
+BENCHMARKS = ('sampling', 'parse', 'padding', 'match_sizes', 'morph',
+              'startup')
+# Modules imported by each method of ssd.py, and the time (in seconds)
+# a fresh interpreter importing them should take at most.
+STARTUP = {'help': ((), 0.08),
+           'deterministic': (('morphing',), 0.25),
+           'target': (('page', 'morphing'), 0.25),
+           'distribution': (('morphing', 'sampling'), 0.25),
+           'batch': (('batch',), 0.25)}
+# Modules no method should import at start-up.
+HEAVY_MODULES = ('scipy', 'sklearn', 'PIL', 'bs4')
+# Extensions of the synthetic objects.
+EXTENSIONS = ('png', 'jpg', 'css', 'svg', 'js')
+
+def synthetic_png(size):
+    """Returns a valid PNG image of about size bytes (at least 67).
+    """
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+        return struct.pack('>I', len(data)) + kind + data + \
+               struct.pack('>I', crc)
+    # 1x1 grey image; the rest of the size is taken by a private chunk.
+    ihdr = struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0)
+    idat = zlib.compress(b'\x00\x80')
+    head = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IDAT', idat)
+    end = chunk(b'IEND', b'')
+    fill = max(0, size - len(head) - len(end) - 12)
+
+    return head + chunk(b'prIv', os.urandom(fill)) + end
+
+def synthetic_jpeg(size):
+    """Returns JPEG-like data (SOI, APP0, comment, EOI) of size bytes
+    (at least 24).
+    """
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00' + \
+           b'\x00\x01\x00\x01\x00\x00'
+    fill = max(0, size - 2 - len(app0) - 4 - 2)
+
+    return b'\xff\xd8' + app0 + b'\xff\xfe' + \
+           struct.pack('>H', min(fill + 2, 0xffff)) + \
+           os.urandom(fill) + b'\xff\xd9'
+
+def synthetic_text(ext, size):
+    """Returns CSS, SVG or JS text of about size bytes.
+    """
+    if ext == 'css':
+        rule = '.c{} {{ color: #{:06x}; margin: 0 auto; }}\n'
+    elif ext == 'svg':
+        rule = '<rect x="{}" y="0" width="1" height="1" fill="#{:06x}"/>\n'
+    else:
+        rule = 'var v{} = 0x{:06x};\n'
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = rule.format(i, i * 2654435761 % 0xffffff)
+        lines.append(line)
+        total += len(line)
+        i += 1
+    text = ''.join(lines)
+    if ext == 'svg':
+        text = '<svg xmlns="http://www.w3.org/2000/svg">\n' + text + '</svg>\n'
+
+    return text
+
+def synthetic_object(ext, size):
+    """Returns the content of a synthetic object of about size bytes.
+    """
+    if ext == 'png':
+        return synthetic_png(size)
+    elif ext == 'jpg':
+        return synthetic_jpeg(size)
+
+    return synthetic_text(ext, size)
+
+def generate_site(outdir, pages=10, objects=20, shared=0.5, mean_size=10000,
+                  html_size=8000, extensions=EXTENSIONS):
+    """Generates a synthetic site.
+
+    Object sizes are drawn from a lognormal distribution.
+
+    Parameters
+    ----------
+    outdir : str
+        Directory of the site.
+    pages : int (Default: 10)
+        Number of pages.
+    objects : int (Default: 20)
+        Number of objects of each page.
+    shared : float (Default: 0.5)
+        Fraction of the objects of a page taken from objects shared
+        by all the pages.
+    mean_size : int (Default: 10000)
+        Median size of the objects.
+    html_size : int (Default: 8000)
+        Approximate size of the HTML pages.
+    extensions : list of str (Default: EXTENSIONS)
+        Extensions of the objects, used in turn.
+
+    Returns
+    -------
+    pages : list of str
+        HTML files of the pages.
+    """
+    def make(name, ext):
+        size = int(np.random.lognormal(np.log(mean_size), 1.0)) + 100
+        path = os.path.join(ext, '{}.{}'.format(name, ext))
+        fname = os.path.join(outdir, path)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        with open(fname, 'wb') as f:
+            f.write(synthetic_object(ext, size))
+        return path
+
+    n_shared = int(objects * shared)
+    common = [make('shared-{}'.format(i), extensions[i % len(extensions)])
+              for i in range(n_shared)]
+    fnames = []
+    for p in range(pages):
+        paths = common + [make('p{}-{}'.format(p, i),
+                               extensions[i % len(extensions)])
+                          for i in range(objects - n_shared)]
+        head = []
+        body = []
+        for path in paths:
+            ext = os.path.splitext(path)[1]
+            if ext == '.css':
+                head.append('<link rel="stylesheet" href="{}">'.format(path))
+            elif ext == '.js':
+                head.append('<script src="{}"></script>'.format(path))
+            else:
+                body.append('<img src="{}" alt="">'.format(path))
+        # Non-ASCII attributes with entities (which HTMLParser
+        # unescapes) must not break parsing.
+        body.append('<p title="caf\xc3\xa9 &amp; th\xc3\xa9">'
+                    '<img alt="\xc3\xa9&nbsp;"></p>')
+        text = synthetic_text('css', max(0, html_size - 200 * len(paths)))
+        html = ('<!DOCTYPE html>\n<html><head>\n' + '\n'.join(head) +
+                '\n<style>\n' + text + '</style>\n</head><body>\n' +
+                '\n'.join(body) + '\n</body></html>\n')
+        fname = os.path.join(outdir, 'page-{}.html'.format(p))
+        with open(fname, 'w') as f:
+            f.write(html)
+        fnames.append(fname)
+
+    return fnames
+
+def generate_distributions(outdir, mean_count=40, mean_size=20000,
+                           points=2000):
+    """Generates synthetic distributions, as histograms (.his) and
+    KDEs (.npz), for the number of objects, the size of the HTML page
+    and the size of the objects.
+
+    Returns
+    -------
+    histograms : (str, str, str)
+        Histogram files of count, HTML and objects.
+    kdes : (str, str, str)
+        KDE files of count, HTML and objects.
+    """
+    samples = {'count': np.random.poisson(mean_count, points) + 1,
+               'html': np.random.lognormal(np.log(mean_size), 1.0, points),
+               'objs': np.random.lognormal(np.log(mean_size), 1.5, points)}
+    histograms = []
+    kdes = []
+    for name in ('count', 'html', 'objs'):
+        data = samples[name].astype(int)
+        values, counts = np.unique(data, return_counts=True)
+        fname = os.path.join(outdir, name + '.his')
+        with open(fname, 'w') as f:
+            for v, c in zip(values, counts):
+                f.write('{} {!r}\n'.format(v, c / float(points)))
+        histograms.append(fname)
+        fname = os.path.join(outdir, name + '.npz')
+        bandwidth = 1.0 if name == 'count' else 0.05 * np.median(data)
+        save_kde(FlatKDE(data, bandwidth), fname)
+        kdes.append(fname)
+
+    return tuple(histograms), tuple(kdes)
+
+def measure(f, repeat):
+    """Calls f repeat times; returns the duration of each call.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+
+    return times
+
+def summarize(times, items=1):
+    """Summary of the durations of calls processing items each.
+    """
+    times = np.array(times)
+    total = times.sum()
+
+    return {'calls': len(times),
+            'mean': float(times.mean()),
+            'p50': float(np.percentile(times, 50)),
+            'p90': float(np.percentile(times, 90)),
+            'p99': float(np.percentile(times, 99)),
+            'max': float(times.max()),
+            'throughput': items * len(times) / total if total > 0 else None,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def bench_sampling(histograms, kdes, repeat):
+    results = {}
+    samplers = {'histogram': sampling.Histogram(*histograms),
+                'kde': sampling.KDEIndividual(*kdes),
+                'kde-truncated': sampling.KDETruncated(*kdes)}
+    for name, sampler in sorted(samplers.items()):
+        results[name] = summarize(measure(sampler.sample_page, repeat))
+        results[name + '-constrained'] = summarize(measure(
+            lambda: sampler.sample_page(30, 10000, 500), repeat))
+
+    return results
+
+def bench_parse(pages, repeat):
+    """Times the parsing of the pages (without cache), and checks
+    that the references found are the ones BeautifulSoup finds.
+    """
+    times = []
+    for i in range(repeat):
+        times += measure(lambda: [page.Page(p) for p in pages], 1)
+    results = {'page': summarize(times, len(pages))}
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        return results
+    equivalent = True
+    for p in pages:
+        with open(p) as f:
+            soup = BeautifulSoup(f.read(), 'html.parser')
+        found = set(x['src'] for x in soup.find_all('img', src=True))
+        found |= set(x['href'] for x in soup.find_all('link', href=True))
+        found |= set(x['src'] for x in soup.find_all('script', src=True))
+        parsed = set(obj['path'] for obj in page.Page(p).objects)
+        equivalent = equivalent and found == parsed
+    results['bs4_equivalent'] = equivalent
+
+    return results
+
+def bench_padding(site, tmpdir, repeat):
+    """Times the padders (padded_parts and write_parts) of each
+    extension of the site's objects.
+    """
+    results = {}
+    for ext in EXTENSIONS:
+        directory = os.path.join(site, ext)
+        if ext not in PADDERS or not os.path.isdir(directory):
+            continue
+        fnames = [os.path.join(directory, x)
+                  for x in sorted(os.listdir(directory))]
+        dst = os.path.join(tmpdir, 'padded.' + ext)
+        padded = [0]
+        def pad():
+            for fname in fnames:
+                target = int(os.path.getsize(fname) * 1.5) + 64
+                write_parts(padded_parts(fname, target), dst)
+                padded[0] += target
+        times = measure(pad, repeat)
+        results[ext] = summarize(times, len(fnames))
+        results[ext]['bytes_per_second'] = padded[0] / sum(times)
+
+    return results
+
+def bench_match_sizes(repeat):
+    results = {}
+    for n in (10, 100, 1000):
+        original = np.random.randint(100, 100000, n).tolist()
+        target = [x + 1000 for x in original] + \
+                 np.random.randint(100, 100000, n).tolist()
+        results[str(n)] = summarize(measure(
+            lambda: morphing.match_sizes(original, target), repeat), n)
+
+    return results
+
+def bench_morph(pages, kdes, tmpdir, repeat):
+    """Times end-to-end morphing of the pages, with P-ALPaCA (KDE)
+    and D-ALPaCA.
+    """
+    sampler = sampling.KDEIndividual(*kdes)
+    runs = {'p-alpaca': lambda p, out: morphing.morph_page_distribution(
+                            p, sampler, out),
+            'd-alpaca': lambda p, out: morphing.morph_page_deterministic(
+                            p, 5000, 10, 100000, out)}
+    results = {}
+    for name, run in sorted(runs.items()):
+        out = os.path.join(tmpdir, name)
+        def morph_all():
+            for p in pages:
+                run(p, out)
+        results[name] = summarize(measure(morph_all, repeat), len(pages))
+        shutil.rmtree(out, ignore_errors=True)
+
+    return results
+
+def bench_startup(repeat):
+    """Times the imports of each method of ssd.py in a fresh
+    interpreter, and reports the heavy modules they load.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for method, (modules, target) in sorted(STARTUP.items()):
+        code = 'import sys, json, time, logging, argparse, metrics\n'
+        code += ''.join('import {}\n'.format(m) for m in modules)
+        code += 'print " ".join(m for m in {!r} if m in sys.modules)'.format(
+                    HEAVY_MODULES)
+        cmd = [sys.executable, '-c', code]
+        heavy = [None]
+        def start():
+            heavy[0] = subprocess.check_output(cmd, cwd=directory).split()
+        times = measure(start, repeat)
+        results[method] = summarize(times)
+        results[method]['target'] = target
+        results[method]['heavy_modules'] = heavy[0]
+        fast = bool(np.median(times) <= target)
+        results[method]['within_target'] = fast and not heavy[0]
+
+    return results
+
+def run_benchmarks(benchmarks=BENCHMARKS, pages=10, objects=20, repeat=5,
+                   seed=0):
+    """Runs the benchmarks on a synthetic site.
+
+    Returns
+    -------
+    results : dict
+        Results of each benchmark.
+    """
+    np.random.seed(seed)
+    tmpdir = tempfile.mkdtemp(prefix='alpaca-benchmark-')
+    try:
+        site = os.path.join(tmpdir, 'site')
+        fnames = generate_site(site, pages, objects)
+        histograms, kdes = generate_distributions(tmpdir)
+        results = {'settings': {'pages': pages, 'objects': objects,
+                                'repeat': repeat, 'seed': seed}}
+        if 'sampling' in benchmarks:
+            results['sampling'] = bench_sampling(histograms, kdes, repeat * 20)
+        if 'parse' in benchmarks:
+            results['parse'] = bench_parse(fnames, repeat)
+        if 'padding' in benchmarks:
+            results['padding'] = bench_padding(site, tmpdir, repeat)
+        if 'match_sizes' in benchmarks:
+            results['match_sizes'] = bench_match_sizes(repeat * 20)
+        if 'morph' in benchmarks:
+            results['morph'] = bench_morph(fnames, kdes, tmpdir, repeat)
+        if 'startup' in benchmarks:
+            results['startup'] = bench_startup(repeat * 2)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return results
+
+def print_results(results, prefix=''):
+    """Prints results, one line per benchmark.
+    """
+    for name, value in sorted(results.items()):
+        if name == 'settings':
+            continue
+        if isinstance(value, dict) and 'mean' not in value:
+            print_results(value, prefix + name + '.')
+        elif isinstance(value, dict):
+            print '{:<36} p50 {:.6f}s  p90 {:.6f}s  p99 {:.6f}s  {:.1f}/s' \
+                  '  rss {} KB'.format(prefix + name, value['p50'],
+                                       value['p90'], value['p99'],
+                                       value['throughput'] or 0,
+                                       value['peak_rss_kb'])
+        else:
+            print '{:<36} {}'.format(prefix + name, value)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Benchmarks.')
+
+    parser.add_argument('--pages', type=int, default=10,
+                        help='Number of pages of the synthetic site.')
+    parser.add_argument('--objects', type=int, default=20,
+                        help='Number of objects of each page.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times each benchmark is run.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the synthetic data.')
+    parser.add_argument('--only', type=str, nargs='+', choices=BENCHMARKS,
+                        default=BENCHMARKS, help='Benchmarks to run.')
+    parser.add_argument('--output', type=str,
+                        help='Write the results into this JSON file.')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.pages, args.objects,
+                             args.repeat, args.seed)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
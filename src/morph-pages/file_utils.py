@@ -1,6 +1,6 @@
 import os
+import hashlib
 from shutil import copyfile
-from PIL import PngImagePlugin
 
 def file_size(fname):
     """Returns the size in byte of a file.
@@ -9,6 +9,45 @@ def file_size(fname):
     """
     return os.stat(fname).st_size
 
+def file_signature(fname):
+    """Returns (mtime, size, inode) of a file, or None if it does
+    not exist.
+
+    Wrapper around os.stat call.
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+
+    return (st.st_mtime, st.st_size, st.st_ino)
+
+def file_digest(fname, buffer_size=64*1024):
+    """Returns the SHA-1 digest (hex) of the content of a file.
+    """
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+# Digests of files: (fname, signature) -> digest.
+_DIGESTS = {}
+
+def cached_digest(fname, signature):
+    """Returns file_digest(fname), cached as long as the signature
+    of the file (see file_signature) does not change.
+    """
+    key = (fname, signature)
+    digest = _DIGESTS.get(key)
+    if digest is None:
+        if len(_DIGESTS) > 4096:
+            _DIGESTS.clear()
+        digest = _DIGESTS[key] = file_digest(fname)
+
+    return digest
+
 def copy_file(src, dst):
     """Copy file src into dst.
     
@@ -16,6 +55,22 @@ def copy_file(src, dst):
     """
     copyfile(src, dst)
 
+def copy_range(src, fdst, offset, length, buffer_size=64*1024):
+    """Append length bytes of file src, starting at offset, to the
+    open file fdst, through a buffer of buffer_size bytes.
+    """
+    done = 0
+    with open(src, 'rb') as fsrc:
+        fsrc.seek(offset)
+        while done < length:
+            buf = fsrc.read(min(buffer_size, length - done))
+            if not buf:
+                break
+            fdst.write(buf)
+            done += len(buf)
+    if done < length:
+        raise IOError('{} is shorter than expected.'.format(src))
+
 def dir_name(path):
     """Directory name.
 
@@ -60,25 +115,6 @@ def file_extension(fname):
 
     return ext[1:]
 
-# wrapper around PIL 1.1.6 Image.save to preserve PNG metadata
-# public domain, Nick Galbreath
-# http://blog.modp.com/2007/08/python-pil-and-png-metadata-take-2.html
-def save_png(im, fout):
-    """Stores a PNG images keeping `info'.
-    """
-    # they are not user-added metadata
-    reserved = ('interlace', 'gamma', 'dpi', 'transparency', 'aspect')
-    # undocumented class
-    meta = PngImagePlugin.PngInfo()
-    # copy metadata into new object
-    for k,v in im.info.iteritems():
-        if k in reserved:
-            continue
-        meta.add_text(k, v, 0)
-
-    im.save(fout, "PNG", pnginfo=meta)
-
-
 class FilePaddingError(Exception):
     
 
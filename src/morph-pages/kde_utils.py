@@ -0,0 +1,187 @@
+"""Flat on-disk format for KDE distributions.
+
+A KDE is stored as an uncompressed .npz archive containing the
+kernel centers (one row per data point), their weights, the
+bandwidth and the kernel type. Unlike a pickled sklearn
+KernelDensity, loading it does not need sklearn, does not execute
+arbitrary code, and the arrays can be memory-mapped, so that many
+worker processes share the same pages.
+
+Pickled KDEs can be converted with:
+
+    python kde_utils.py counts.kde counts.npz
+"""
+import os
+import pickle
+import struct
+import zipfile
+import numpy as np
+from argparse import ArgumentParser
+
+FORMAT_VERSION = 1
+KERNELS = ('gaussian', 'tophat')
+
+class FlatKDE(object):
+    """Kernel density estimate described by its centers.
+
+    Exposes the same sample() method as sklearn's KernelDensity.
+
+    Parameters
+    ----------
+    centers : array of float, shape (n, d)
+        Data points of the KDE.
+    bandwidth : float
+        Bandwidth of the kernel.
+    kernel : str (Default: 'gaussian')
+        Either 'gaussian' or 'tophat'.
+    weights : array of float, shape (n,) (Default: None)
+        Weight of each data point.
+    """
+
+    def __init__(self, centers, bandwidth, kernel='gaussian', weights=None):
+        if kernel not in KERNELS:
+            raise Exception('Kernel {} not supported.'.format(kernel))
+        centers = np.asarray(centers, dtype=float)
+        if centers.ndim == 1:
+            centers = centers[:, np.newaxis]
+        if weights is None:
+            weights = np.ones(len(centers))
+        self.centers = centers
+        self.weights = np.asarray(weights, dtype=float)
+        self.bandwidth = float(bandwidth)
+        self.kernel = kernel
+        self._cumulative = np.cumsum(self.weights)
+
+    def sample(self, n_samples=1):
+        """Draws n_samples samples.
+
+        Returns
+        -------
+        samples : array of float, shape (n_samples, d)
+            Samples.
+        """
+        u = np.random.random(n_samples) * self._cumulative[-1]
+        idx = np.searchsorted(self._cumulative, u, side='right')
+        idx = np.minimum(idx, len(self._cumulative) - 1)
+        data = self.centers[idx]
+        dim = data.shape[1]
+        if self.kernel == 'gaussian':
+            return data + self.bandwidth * np.random.normal(size=data.shape)
+        # Tophat: uniform in the ball of radius bandwidth.
+        if dim == 1:
+            return data + np.random.uniform(-self.bandwidth, self.bandwidth,
+                                            size=data.shape)
+        from scipy.special import gammainc
+        x = np.random.normal(size=data.shape)
+        s_sq = (x**2).sum(axis=1)
+        correction = (gammainc(0.5*dim, 0.5*s_sq) ** (1./dim) *
+                      self.bandwidth / np.sqrt(s_sq))
+
+        return data + x * correction[:, np.newaxis]
+
+def to_flat(kde):
+    """Converts a fitted sklearn KernelDensity into a FlatKDE.
+
+    One dimensional KDEs are compacted by merging the kernels
+    that share the same center.
+    """
+    if isinstance(kde, FlatKDE):
+        return kde
+    centers = np.asarray(kde.tree_.data)
+    weights = getattr(kde.tree_, 'sample_weight', None)
+    if weights is None:
+        weights = np.ones(len(centers))
+    weights = np.asarray(weights, dtype=float)
+    if centers.shape[1] == 1:
+        centers, inverse = np.unique(centers[:, 0], return_inverse=True)
+        weights = np.bincount(inverse, weights=weights)
+
+    return FlatKDE(centers, kde.bandwidth, kde.kernel, weights)
+
+def save_kde(kde, fname):
+    """Stores a KDE (FlatKDE or sklearn KernelDensity) into fname
+    in the flat format.
+    """
+    kde = to_flat(kde)
+    with open(fname, 'wb') as f:
+        np.savez(f, version=np.array(FORMAT_VERSION),
+                 centers=kde.centers,
+                 weights=kde.weights,
+                 bandwidth=np.array(kde.bandwidth),
+                 kernel=np.array(kde.kernel.encode('ascii')))
+
+def load_kde(fname, mmap=True):
+    """Loads a KDE stored in the flat format.
+
+    Parameters
+    ----------
+    fname : str
+        Name of the .npz file.
+    mmap : bool (Default: True)
+        Memory-map the centers and the weights instead of
+        reading them.
+
+    Returns
+    -------
+    kde : FlatKDE
+        The KDE.
+    """
+    arrays = {}
+    with zipfile.ZipFile(fname) as z:
+        for info in z.infolist():
+            name = info.filename[:-len('.npy')]
+            if mmap and name in ('centers', 'weights') and \
+                    info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = _mmap_member(fname, info)
+            else:
+                with z.open(info) as f:
+                    arrays[name] = np.lib.format.read_array(f,
+                                                    allow_pickle=False)
+    if int(arrays['version']) != FORMAT_VERSION:
+        raise Exception('Unsupported KDE file version: {}.'.format(
+                        arrays['version']))
+    kernel = arrays['kernel'][()]
+    if isinstance(kernel, bytes):
+        kernel = kernel.decode('ascii')
+
+    return FlatKDE(arrays['centers'], arrays['bandwidth'][()], kernel,
+                   arrays['weights'])
+
+def read_kde(fname):
+    """Reads a KDE, either in the flat format (.npz) or as a
+    pickled sklearn KernelDensity.
+    """
+    if os.path.splitext(fname)[1] == '.npz':
+        return load_kde(fname)
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
+
+def _mmap_member(fname, info):
+    """Memory-maps an uncompressed .npy member of a zip file.
+    """
+    with open(fname, 'rb') as f:
+        # Skip the local file header.
+        f.seek(info.header_offset)
+        header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    order = 'F' if fortran else 'C'
+
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order=order)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Convert pickled KDEs into the ' +
+                                        'flat format.')
+    parser.add_argument('src', type=str, help='Pickled KernelDensity.')
+    parser.add_argument('dst', type=str, help='Destination .npz file.')
+    args = parser.parse_args()
+
+    save_kde(read_kde(args.src), args.dst)
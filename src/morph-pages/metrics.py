@@ -0,0 +1,137 @@
+"""Instrumentation.
+
+Morphing reports timings (parse, sample, plan, pad, html) and
+counters (retries, bytes padded, padding objects, ...) through the
+metrics registered with set_metrics(). By default, they are dropped
+(Metrics is a no-op); Recorder aggregates them in memory, and
+Callback hands them to a function (e.g., to export them to a
+monitoring system).
+
+Metrics are per process: objects morphed in a pool of processes
+are not reported to the parent's metrics.
+"""
+import time
+import threading
+
+class _NullTimer(object):
+    """Timer doing nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class _Timer(object):
+    """Reports the time spent in a with block to metrics."""
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.timing(self.name, time.time() - self.start)
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class Metrics(object):
+    """Metrics interface; drops everything.
+    """
+
+    def count(self, name, value=1):
+        """Adds value to counter name.
+        """
+        pass
+
+    def timing(self, name, seconds):
+        """Records that stage name took seconds.
+        """
+        pass
+
+    def timer(self, name):
+        """Context manager recording the time spent in its block
+        as a timing of stage name.
+        """
+        return _NULL_TIMER
+
+class Recorder(Metrics):
+    """Metrics aggregated in memory.
+    """
+
+    def __init__(self):
+        self.counters = {}
+        # name -> [calls, total seconds, max seconds]
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, seconds):
+        with self._lock:
+            t = self.timings.setdefault(name, [0, 0., 0.])
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def snapshot(self):
+        """Returns the counters, and the calls, total and maximum
+        time of each stage.
+        """
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'timings': dict((name, {'calls': t[0], 'total': t[1],
+                                            'max': t[2]})
+                                    for name, t in self.timings.items())}
+
+class Callback(Metrics):
+    """Metrics handed to a function f(kind, name, value), where kind
+    is either 'count' or 'timing'.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def count(self, name, value=1):
+        self.f('count', name, value)
+
+    def timing(self, name, seconds):
+        self.f('timing', name, seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+# Metrics of the process.
+_metrics = Metrics()
+
+def set_metrics(metrics):
+    """Registers the metrics of the process (None: no metrics).
+    Returns the previous ones.
+    """
+    global _metrics
+    previous = _metrics
+    _metrics = metrics if metrics is not None else Metrics()
+
+    return previous
+
+def get_metrics():
+    return _metrics
+
+def count(name, value=1):
+    """Adds value to counter name of the registered metrics.
+    """
+    _metrics.count(name, value)
+
+def timer(name):
+    """Times a with block into the registered metrics.
+    """
+    return _metrics.timer(name)
@@ -0,0 +1,228 @@
+"""On-the-fly morphing of web pages.
+
+MorphingMiddleware is a WSGI middleware serving the pages of a
+document root morphed with P-ALPaCA, without writing them to disk:
+a morph plan is computed when the HTML page is requested, and the
+page and its objects are streamed from the original files followed
+by the padding. Plans are kept for each visitor (identified by a
+cookie) for a short time, so that the objects requested after the
+page are padded consistently with it.
+
+Example:
+
+    from wsgiref.simple_server import make_server
+    app = MorphingMiddleware(not_found, 'www/', sampler)
+    make_server('', 8000, app).serve_forever()
+"""
+import os
+import time
+import mimetypes
+import posixpath
+import threading
+import binascii
+import morphing
+from morph_utils import data_part, html_parts, iter_parts, padded_parts
+from morph_utils import iter_random_bytes
+
+HTML_EXTENSIONS = ('.html', '.htm')
+
+class PlanStore(object):
+    """In-memory store of the objects to serve to each visitor.
+
+    Entries expire ttl seconds after they were last set.
+
+    Parameters
+    ----------
+    ttl : float (Default: 300)
+        Lifetime of the entries, in seconds.
+    capacity : int (Default: 10000)
+        Maximum number of visitors.
+    """
+
+    def __init__(self, ttl=300, capacity=10000):
+        self.ttl = ttl
+        self.capacity = capacity
+        self._visitors = {}
+        self._lock = threading.Lock()
+
+    def update(self, visitor, objects):
+        """Adds objects (URL path -> (source, size)) to the objects
+        of visitor.
+        """
+        now = time.time()
+        with self._lock:
+            if visitor not in self._visitors and \
+                    len(self._visitors) >= self.capacity:
+                self._purge(now)
+            _, known = self._visitors.get(visitor, (None, {}))
+            known.update(objects)
+            self._visitors[visitor] = (now + self.ttl, known)
+
+    def get(self, visitor, path):
+        """Returns (source, size) of the object at URL path for
+        visitor, or None.
+        """
+        with self._lock:
+            entry = self._visitors.get(visitor)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._visitors[visitor]
+                return None
+            return entry[1].get(path)
+
+    def _purge(self, now):
+        """Removes the expired entries, and the oldest ones if
+        the store is still full.
+        """
+        for visitor, (expiry, _) in self._visitors.items():
+            if expiry < now:
+                del self._visitors[visitor]
+        if len(self._visitors) >= self.capacity:
+            oldest = sorted(self._visitors, key=lambda v: self._visitors[v][0])
+            for visitor in oldest[:len(oldest) - self.capacity + 1]:
+                del self._visitors[visitor]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._visitors)
+
+class MorphingMiddleware(object):
+    """WSGI middleware morphing the pages of a document root.
+
+    HTML pages are morphed with P-ALPaCA for each request. The
+    objects of the morphed page, including the padding objects, are
+    served to the visitor who requested the page; other requests
+    are passed to app.
+
+    Parameters
+    ----------
+    app : WSGI application
+        Application serving the requests which are not morphed.
+    docroot : str
+        Document root.
+    page_sampler : sampling.PageSampler
+        Page sampler.
+    ttl : float (Default: 300)
+        Time (in seconds) during which the objects of a morphed
+        page are served to the visitor.
+    cookie : str (Default: 'alpaca')
+        Name of the cookie identifying the visitors.
+    index : str (Default: 'index.html')
+        Page served for directories.
+    max_attempts : int (Default: 100)
+        Maximum number of samples tried for each page.
+    """
+
+    def __init__(self, app, docroot, page_sampler, ttl=300, cookie='alpaca',
+                 index='index.html', max_attempts=100):
+        self.app = app
+        self.docroot = os.path.realpath(docroot)
+        self.page_sampler = page_sampler
+        self.plans = PlanStore(ttl)
+        self.cookie = cookie
+        self.index = index
+        self.max_attempts = max_attempts
+
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD', 'GET') not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+        path = environ.get('PATH_INFO') or '/'
+        if path.endswith('/'):
+            path += self.index
+        path = posixpath.normpath(path)
+        visitor = self._visitor(environ)
+
+        if posixpath.splitext(path)[1].lower() in HTML_EXTENSIONS:
+            fname = self._file(path)
+            if fname is not None:
+                return self._serve_page(path, fname, visitor, start_response)
+        elif visitor is not None:
+            entry = self.plans.get(visitor, path)
+            if entry is not None:
+                return self._serve_object(path, entry, start_response)
+
+        return self.app(environ, start_response)
+
+    def _serve_page(self, path, fname, visitor, start_response):
+        """Morphs the page at URL path, and records its objects for
+        visitor.
+        """
+        plan = morphing.plan_page_distribution(fname, self.page_sampler,
+                                               self.max_attempts,
+                                               root=self.docroot)
+        base = posixpath.dirname(path)
+        objects = {}
+        for source, rel, size in zip(plan.sources, plan.paths, plan.sizes):
+            # Objects outside the document root (e.g., ../x.css) are
+            # left to the application.
+            if not self._in_docroot(source):
+                continue
+            objects[self._url(base, rel)] = (source, size)
+        for rel, size in zip(plan.padding_paths(), plan.padding):
+            objects[self._url(base, rel)] = (None, size)
+
+        headers = self._headers('text/html', plan.target_html_size)
+        if visitor is None:
+            visitor = binascii.hexlify(os.urandom(16))
+            headers.append(('Set-Cookie', '{}={}; Path=/; HttpOnly'.format(
+                            self.cookie, visitor)))
+        self.plans.update(visitor, objects)
+
+        start_response('200 OK', headers)
+        return iter_parts(html_parts(plan.fname, plan.body, plan.add_to_html,
+                                     plan.target_html_size, plan.rewrites))
+
+    def _serve_object(self, path, entry, start_response):
+        """Serves a morphed object, or a padding object.
+        """
+        source, size = entry
+        if source is None:
+            parts = [data_part(iter_random_bytes(size))]
+        else:
+            parts = padded_parts(source, size)
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+        start_response('200 OK', self._headers(mimetype, size))
+        return iter_parts(parts)
+
+    def _headers(self, mimetype, size):
+        """Headers of a morphed response.
+
+        Morphed responses are different for each visit, and must
+        not be cached.
+        """
+        return [('Content-Type', mimetype),
+                ('Content-Length', str(size)),
+                ('Cache-Control', 'no-store')]
+
+    def _visitor(self, environ):
+        """Returns the visitor identifier from the cookies, or None.
+        """
+        for cookie in environ.get('HTTP_COOKIE', '').split(';'):
+            name, _, value = cookie.strip().partition('=')
+            if name == self.cookie and value:
+                return value
+        return None
+
+    def _file(self, path):
+        """Returns the file at URL path, or None if it does not
+        exist or is outside the document root.
+        """
+        fname = os.path.realpath(os.path.join(self.docroot,
+                                              path.lstrip('/')))
+        if not self._in_docroot(fname) or not os.path.isfile(fname):
+            return None
+        return fname
+
+    def _in_docroot(self, fname):
+        """Returns True if file fname (resolved) is inside the document
+        root.
+        """
+        return os.path.realpath(fname).startswith(self.docroot + os.sep)
+
+    def _url(self, base, rel):
+        """URL path of an object, from its path relative to the page.
+        """
+        return posixpath.normpath(posixpath.join(base,
+                                  rel.replace(os.sep, '/')))
@@ -4,26 +4,40 @@ Functions of this script can be used to morph objects
 of web pages (e.g.: text, images).
 """
 import os
-import page
-import random
 import string
-from PIL import Image
+import struct
+import threading
+import zlib
 from file_utils import *
 
-def morph_html(html, target_size):
-    """Morphs html text.
+# Size of the chunks in which padding is generated.
+CHUNK_SIZE = 64 * 1024
 
-    Accepts html text pads it to a target_size.
-    Returns the padded text.
+# Table mapping random bytes onto [a-zA-Z0-9]. Bytes >= _ACCEPT are
+# discarded, so that each character is mapped from the same number
+# of byte values.
+_CHARS = (string.ascii_letters + string.digits).encode('ascii')
+_ACCEPT = 256 - 256 % len(_CHARS)
+_TABLE = (_CHARS * (256 // len(_CHARS) + 1))[:256]
+_REJECT = bytes(bytearray(range(_ACCEPT, 256)))
 
-    Parameters
-    ----------
-    html : str
-        HTML text to morph.
-    target_size : int
-        Size (in bytes) that the text should have.
-    """
-    return __pad_html(html, target_size)
+# Comments used to pad text files.
+HTML_COMMENT = ('<!--', '-->')
+CSS_COMMENT = ('/*', '*/')
+# A newline ends a possible line comment at the end of the script.
+JS_COMMENT = ('\n/*', '*/')
+
+# Padders, by file extension: extension -> (padder, min_padding).
+# See register_padder().
+PADDERS = {}
+
+# Size of the WOFF and WOFF2 headers.
+WOFF_HEADER = 44
+WOFF2_HEADER = 48
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Keyword of the PNG tEXt chunk containing the padding.
+PNG_KEYWORD = b'Comment'
 
 def morph_object(fname, dst, target_size):
     """Morphs an object.
@@ -37,52 +51,192 @@ def morph_object(fname, dst, target_size):
     target_size : int
         Size (in bytes) that the image should have.
     """
-    ext = file_extension(fname)
-    if ext == 'png':
-        morph = __pad_jpeg
-    elif ext == 'jpg':
-        morph = __pad_jpeg
-    elif ext == 'bmp':
-        morph = __pad_bmp
-    elif ext == 'gif':
-        morph = __pad_gif
-    elif ext == 'tiff':
-        morph = __pad_tiff
-    elif ext == 'pdf':
-        morph = __pad_pdf
-    elif ext == 'css':
-        morph = __pad_css
-    elif ext == 'svg':
-        morph = __pad_svg
-    else:
+    write_parts(padded_parts(fname, target_size), dst)
+
+def padded_parts(fname, target_size):
+    """Returns the parts of an object padded to target_size.
+
+    Parts describe the padded object without materialising it,
+    and can either be written into a file (write_parts) or
+    streamed (iter_parts).
+
+    Parameters
+    ----------
+    fname : str
+        Name of the object.
+    target_size : int
+        Size (in bytes) that the object should have.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded object.
+    """
+    morph, _ = _padder(fname)
+
+    return morph(fname, target_size)
+
+def register_padder(ext, padder, min_padding=1):
+    """Registers the padder of files with extension ext.
+
+    Parameters
+    ----------
+    ext : str
+        File extension (without dot).
+    padder : function
+        padder(fname, target_size) returns the parts of fname
+        padded to target_size.
+    min_padding : int (Default: 1)
+        Smallest (non-zero) number of bytes the padder can add.
+    """
+    PADDERS[ext.lower()] = (padder, min_padding)
+
+def min_padding(fname):
+    """Returns the smallest (non-zero) number of bytes that can be
+    added to the object fname when morphing it.
+    """
+    _, padding = _padder(fname)
+
+    return padding
+
+def can_pad(fname):
+    """Returns True if a padder is registered for the type of file
+    fname.
+    """
+    return file_extension(fname).lower() in PADDERS
+
+def _padder(fname):
+    ext = file_extension(fname).lower()
+    if ext not in PADDERS:
         raise NotImplementedError('Morphing files with extension {}'.format(ext))
-    
-    morph(fname, dst, target_size)
 
-def create_object(fname, size):
+    return PADDERS[ext]
+
+def create_object(fname, size, pool_dir=None):
     """Creates a binary file with random data.
     
     The file can be given any extension.
 
+    With pool_dir, the random data is taken from a pool of blobs,
+    one per size, and the file is a hard link to the blob (or a copy,
+    if the pool is on another file system). The blob of a size is
+    generated the first time it is needed.
+
     Parameters
     ----------
     fname : str
         Name of the file.
     size : int
         Size in bytes of the file.
+    pool_dir : str (Default: None)
+        Directory of the pool of blobs.
     """
     if size <= 0:
         raise FilePaddingError('New file')
-    with open(fname, 'wb') as f:
-        rnd = random_bytes(size)
-        f.write(rnd)
+    if pool_dir is None:
+        write_parts([data_part(iter_random_bytes(size))], fname)
+        return
+    blob = os.path.join(pool_dir, '{}.bin'.format(size))
+    if not os.path.exists(blob):
+        make_path(blob)
+        write_parts([data_part(iter_random_bytes(size))], blob)
+    # Renaming a link onto another link to the same file does nothing
+    # (and leaves the temporary link behind).
+    if os.path.exists(fname) and os.path.samefile(fname, blob):
+        return
+    tmp = '{}.{}-{}.tmp'.format(fname, os.getpid(),
+                                threading.current_thread().ident)
+    try:
+        os.link(blob, tmp)
+    except OSError:
+        write_parts([file_part(blob, 0, size)], fname)
+        return
+    os.rename(tmp, fname)
+    # Another writer linked fname to the blob meanwhile.
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+def file_part(fname, offset, length):
+    """Part made of length bytes of file fname, starting at offset.
+    """
+    return ('file', fname, offset, length)
+
+def data_part(chunks):
+    """Part made of the strings in (the iterable) chunks.
+    """
+    return ('data', chunks)
+
+def write_parts(parts, dst):
+    """Writes parts into file dst.
+
+    File parts are copied and data parts written chunk by chunk,
+    so that memory usage does not depend on the size of the parts.
+
+    The parts are written into a temporary file, which is then
+    renamed to dst: readers (and concurrent writers) of dst never
+    see a partially written file.
+    """
+    tmp = '{}.{}-{}.tmp'.format(dst, os.getpid(),
+                                threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb') as f:
+            for part in parts:
+                if part[0] == 'file':
+                    copy_range(part[1], f, part[2], part[3])
+                else:
+                    for chunk in part[1]:
+                        f.write(chunk)
+        os.rename(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def iter_parts(parts, chunk_size=CHUNK_SIZE):
+    """Yields the content of parts, in strings of at most
+    chunk_size bytes.
+    """
+    for part in parts:
+        if part[0] == 'file':
+            _, fname, offset, length = part
+            with open(fname, 'rb') as f:
+                f.seek(offset)
+                while length > 0:
+                    chunk = f.read(min(length, chunk_size))
+                    if not chunk:
+                        raise IOError('{} is shorter than expected.'.format(
+                                      fname))
+                    length -= len(chunk)
+                    yield chunk
+        else:
+            for chunk in part[1]:
+                yield chunk
 
 def random_chars(n):
-    """Returns a string of random characters in [a-zA-Z0-9].
+    """Returns a string of n random characters in [a-zA-Z0-9].
+
+    Random bytes are mapped onto the characters in bulk, discarding
+    the bytes that would make some characters more likely than others.
     """
-    chars = string.ascii_letters + string.digits
+    chunks = []
+    missing = n
+    while missing > 0:
+        # About 3% of the bytes are discarded.
+        rnd = random_bytes(missing + missing // 16 + 16)
+        rnd = rnd.translate(_TABLE, _REJECT)[:missing]
+        chunks.append(rnd)
+        missing -= len(rnd)
+
+    return b''.join(chunks)
 
-    return ''.join([random.choice(chars) for i in range(n)])
+def iter_random_chars(n, chunk_size=CHUNK_SIZE):
+    """Yields n random characters in [a-zA-Z0-9], in strings
+    of at most chunk_size characters.
+    """
+    while n > 0:
+        rnd = random_chars(min(n, chunk_size))
+        n -= len(rnd)
+        yield rnd
 
 def random_bytes(n):
     """Return a string of n random bytes suitable for cryptographic use.
@@ -92,33 +246,75 @@ def random_bytes(n):
     """
     return os.urandom(n)
 
-def __pad_html(html, target_size):
-    """Pads html text.
+def iter_random_bytes(n, chunk_size=CHUNK_SIZE):
+    """Yields n random bytes, in strings of at most chunk_size bytes.
+    """
+    while n > 0:
+        rnd = random_bytes(min(n, chunk_size))
+        n -= len(rnd)
+        yield rnd
+
+def html_parts(fname, offset, insertion, target_size, rewrites=()):
+    """Returns the parts of an HTML page, with some text inserted
+    (and some spans rewritten), padded to target_size.
 
-    Adds a comment to the provided html text containing random
-    data, so that the corresponding page reaches the target size.
-    
     Parameters
     ----------
-    fname : string
-        HTML text.
+    fname : str
+        Name of the HTML file.
+    offset : int
+        Where to insert the text.
+    insertion : str
+        Text to insert.
     target_size : int
-        Size (in bytes) that the text should have.
+        Size (in bytes) that the page should have.
+    rewrites : list of (int, int, str) (Default: ())
+        Text replacing the bytes between start and end, for
+        non-overlapping (start, end, text).
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded page.
+    """
+    original_size = file_size(fname)
+    size = original_size
+    edits = sorted(list(rewrites) + [(offset, offset, insertion)])
+    parts = []
+    pos = 0
+    for start, end, text in edits:
+        parts.append(file_part(fname, pos, start - pos))
+        parts.append(data_part([text]))
+        size += len(text) - (end - start)
+        pos = end
+    parts.append(file_part(fname, pos, original_size - pos))
+
+    return parts + _comment_padding(size, target_size, HTML_COMMENT,
+                                    'HTML file')
+
+def _text_padding(fname, target_size, comment):
+    """Parts of a text file padded with a comment containing
+    random characters.
+    """
+    size = file_size(fname)
+
+    return [file_part(fname, 0, size)] + _comment_padding(size, target_size,
+                                                          comment, fname)
+
+def _comment_padding(size, target_size, comment, name):
+    """Parts of a comment containing random characters, padding
+    a text of the given size to target_size.
     """
-    size = len(html)
     if size == target_size:
-        return html
-    # Padding size
-    comment_start = '<!--'
-    comment_end = '-->'
+        return []
+    comment_start, comment_end = comment
     pad = target_size - size - len(comment_start) - len(comment_end)
     if pad < 0:
-        raise FilePaddingError('HTML file')
-    # Pad
-    rnd = random_chars(pad)
-    html += '{}{}{}'.format(comment_start, rnd, comment_end)
+        raise FilePaddingError(name)
 
-    return html
+    return [data_part([comment_start]),
+            data_part(iter_random_chars(pad)),
+            data_part([comment_end])]
 
 def __split_html(html, target_size):
     """Reduce the size of the html text, returns
@@ -126,83 +322,94 @@ def __split_html(html, target_size):
     """
     raise NotImplementedError('Splitting HTML files.')
 
-def __pad_css(fname, dst, target_size):
+def __pad_css(fname, target_size):
     """Pads a CSS file.
     
-    Adds a comment at the end of the CSS file, and
-    stores the result in a new file.
+    Adds a comment at the end of the CSS file.
     
     Parameters
     ----------
     fname : string
         CSS file name.
-    dst : string
-        Name of the destination file.
     target : int
         Size (in bytes) that the file should have.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded file.
     """
-    size = file_size(fname)
-    if size == target_size:
-        copy_file(fname, dst)
-        return
-    # Padding size
-    comment_start = '/*'
-    comment_end = '*/'
-    pad = target_size - size - len(comment_start) - len(comment_end)
-    if pad < 0:
-        raise FilePaddingError(fname)
-    with open(fname) as f:
-        text = f.read()
-    # Pad
-    rnd = random_chars(pad) 
-    text += '{}{}{}'.format(comment_start, rnd, comment_end)
-    with open(dst, 'w') as f:
-        f.write(text)
-
-def __pad_png(fname, dst, target_size):
+    return _text_padding(fname, target_size, CSS_COMMENT)
+
+def __pad_png(fname, target_size):
     """Pad a PNG image.
 
-    Adds random content to the comment section
-    of a PNG image so that it gets the required
-    target size.
+    Adds a tEXt chunk ("Comment") with random characters
+    right before the IEND chunk of a PNG image so that it
+    gets the required target size. The image is not decoded.
     
     Parameters
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded image.
     """
-    if file_size(fname) == target_size:
-        copy_file(fname, dst)
-        return
-    # Store tmp image, get its size.
-    # We do this to know the size of the image
-    # when compressed using PIL library. Another option is to
-    # force PIL to use the same compression method which was
-    # used in the original image.
-    img = Image.open(fname)
-    tmpfname = fname + '-tmp.png'
-    # We want 'Comment' section to appear in the
-    # file. Otherwise, we'll have discrepancies in the
-    # size we obtain at the end.
-    if not 'Comment' in img.info:
-        img.info['Comment'] = ''
-    save_png(img, tmpfname)
-    pad = target_size - file_size(tmpfname)
-    remove_file(tmpfname)
+    size = file_size(fname)
+    if size == target_size:
+        return [file_part(fname, 0, size)]
+    pad = target_size - size
     if pad < 0:
         raise FilePaddingError(fname)
-    img = Image.open(fname)
-    rnd = random_bytes(pad)
-    if not 'Comment' in img.info:
-        img.info['Comment'] = ''
-    img.info['Comment'] += rnd
-    save_png(img, dst)
-
-def __pad_jpeg(fname, dst, target_size):
+    # Length, type, keyword, null separator and CRC.
+    overhead = 4 + 4 + len(PNG_KEYWORD) + 1 + 4
+    iend = _png_iend_offset(fname)
+    if iend is None or pad < overhead:
+        # Not a PNG we can parse, or the padding is too small for a
+        # chunk: append the padding (decoders ignore data after IEND).
+        return __pad_jpeg(fname, target_size)
+
+    return [file_part(fname, 0, iend),
+            data_part(_png_text_chunk(PNG_KEYWORD, pad - overhead)),
+            file_part(fname, iend, size - iend)]
+
+def _png_iend_offset(fname):
+    """Returns the offset of the IEND chunk of a PNG image, or None
+    if the file is not a well-formed PNG.
+
+    Only chunk headers are read.
+    """
+    size = file_size(fname)
+    with open(fname, 'rb') as f:
+        if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            return None
+        offset = len(PNG_SIGNATURE)
+        while offset + 12 <= size:
+            f.seek(offset)
+            length, ctype = struct.unpack('>I4s', f.read(8))
+            if ctype == b'IEND':
+                return offset
+            offset += length + 12
+
+    return None
+
+def _png_text_chunk(keyword, n):
+    """Yields a PNG tEXt chunk with n random characters as text.
+    """
+    data = keyword + b'\x00'
+    yield struct.pack('>I', len(data) + n) + b'tEXt' + data
+    crc = zlib.crc32(b'tEXt' + data)
+    for rnd in iter_random_chars(n):
+        crc = zlib.crc32(rnd, crc)
+        yield rnd
+    yield struct.pack('>I', crc & 0xffffffff)
+
+def __pad_jpeg(fname, target_size):
     """Pad a jpeg image.
 
     Adds random data to a jpeg image so that it
@@ -212,22 +419,23 @@ def __pad_jpeg(fname, dst, target_size):
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded image.
     """
-    with open(fname, 'rb') as f:
-        img = f.read()
-    pad = target_size - len(img)
+    size = file_size(fname)
+    pad = target_size - size
     if pad < 0:
         raise FilePaddingError(fname)
-    rnd = random_bytes(pad)
-    img += rnd
-    with open(dst, 'wb') as f:
-        f.write(img)
 
-def __pad_bmp(img, dst, target_size):
+    return [file_part(fname, 0, size),
+            data_part(iter_random_bytes(pad))]
+
+def __pad_bmp(img, target_size):
     """Pad a BMP image.
 
     Adds random data to a jpeg image so that it
@@ -237,76 +445,161 @@ def __pad_bmp(img, dst, target_size):
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
     """
     # Same procedure as JPEG.
-    __pad_jpeg(img, dst, target_size)
+    return __pad_jpeg(img, target_size)
 
-def __pad_gif(img, dst, target_size):
+def __pad_gif(img, target_size):
     """Pad a GIF image.
     
     Parameters
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
     """
     # Same procedure as JPEG.
-    __pad_jpeg(img, dst, target_size)
+    return __pad_jpeg(img, target_size)
+
+def __pad_js(fname, target_size):
+    """Pads a JavaScript file.
+    
+    Adds a comment at the end of the script.
+    
+    Parameters
+    ----------
+    fname : string
+        Script file name.
+    target : int
+        Size (in bytes) that the file should have.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded file.
+    """
+    return _text_padding(fname, target_size, JS_COMMENT)
+
+def __pad_woff(fname, target_size):
+    """Pad a WOFF or WOFF2 font.
+
+    Adds a private data block with random data at the end of
+    the font, and updates the font header accordingly.
+    
+    Parameters
+    ----------
+    fname : str
+        Name of the font file.
+    target_size : int
+        Desired size.
 
-def __pad_tiff(img, dst, target_size):
+    Returns
+    -------
+    parts : list
+        Parts of the padded font.
+    """
+    size = file_size(fname)
+    if size == target_size:
+        return [file_part(fname, 0, size)]
+    pad = target_size - size
+    if pad < 0:
+        raise FilePaddingError(fname)
+    with open(fname, 'rb') as f:
+        header = f.read(WOFF2_HEADER)
+    # Offset of the private block fields (privOffset, privLength).
+    if header[:4] == b'wOFF':
+        header_size, priv = WOFF_HEADER, 36
+    elif header[:4] == b'wOF2':
+        header_size, priv = WOFF2_HEADER, 40
+    else:
+        return __pad_jpeg(fname, target_size)
+    header = header[:header_size]
+    priv_offset, priv_length = struct.unpack('>II', header[priv:priv+8])
+    if priv_length and priv_offset + priv_length == size:
+        # Extend the private block at the end of the font.
+        align = 0
+    elif priv_length:
+        raise FilePaddingError(fname)
+    else:
+        # Private blocks start on 4-byte boundaries.
+        align = -size % 4
+        priv_offset = size + align
+        if pad <= align:
+            raise FilePaddingError(fname)
+    priv_length = target_size - priv_offset
+    header = (header[:8] + struct.pack('>I', target_size) + header[12:priv] +
+              struct.pack('>II', priv_offset, priv_length) +
+              header[priv+8:])
+
+    return [data_part([header]),
+            file_part(fname, header_size, size - header_size),
+            data_part([b'\x00' * align]),
+            data_part(iter_random_bytes(pad - align))]
+
+def __pad_tiff(img, target_size):
     """Pad a TIFF image.
     
     Parameters
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
     """
-    raise NotImplementedError('Morphing TIFF files')
+    # Same procedure as JPEG: readers follow the offsets of the
+    # image directories, and ignore trailing data.
+    return __pad_jpeg(img, target_size)
 
-def __pad_pdf(img, dst, target_size):
+def __pad_pdf(img, target_size):
     """Pad a PDF file.
     
     Parameters
     ----------
     fname : str
         Name of the image file.
-    dst : str
-        Name of the destination file.
     target_size : int
         Desired size.
     """
-    raise NotImplementedError('Morphing PDF files')
+    # Same procedure as JPEG: data after %%EOF is ignored.
+    return __pad_jpeg(img, target_size)
     
-def __pad_svg(fname, dst, target_size):
+def __pad_svg(fname, target_size):
     """Pad a SVG file.
     
-    Adds a (XML) comment at the end of the SVG file, and
-    stores the result in a new file.
+    Adds a (XML) comment at the end of the SVG file.
     
     Parameters
     ----------
     fname : str
         Name of the SVG file
-    dst : str
-        Name of the destination file.
     target : int
         Size (in bytes) that the file should have.
+
+    Returns
+    -------
+    parts : list
+        Parts of the padded file.
     """
-   
-    with open(fname, 'rb') as f:
-        text = f.read()
-        text = __pad_html(text, target_size)
-    
-    with open(dst, 'wb') as f:
-        f.write(text)
+    return _text_padding(fname, target_size, HTML_COMMENT)
+
+register_padder('png', __pad_png)
+register_padder('jpg', __pad_jpeg)
+register_padder('jpeg', __pad_jpeg)
+register_padder('bmp', __pad_bmp)
+register_padder('gif', __pad_gif)
+register_padder('ico', __pad_jpeg)
+register_padder('cur', __pad_jpeg)
+register_padder('tiff', __pad_tiff)
+register_padder('pdf', __pad_pdf)
+register_padder('css', __pad_css, len(CSS_COMMENT[0]) + len(CSS_COMMENT[1]))
+register_padder('svg', __pad_svg, len(HTML_COMMENT[0]) + len(HTML_COMMENT[1]))
+register_padder('js', __pad_js, len(JS_COMMENT[0]) + len(JS_COMMENT[1]))
+register_padder('mjs', __pad_js, len(JS_COMMENT[0]) + len(JS_COMMENT[1]))
+# Fonts. Trailing data is ignored in TrueType/OpenType fonts.
+register_padder('woff', __pad_woff, 4)
+register_padder('woff2', __pad_woff, 4)
+register_padder('ttf', __pad_jpeg)
+register_padder('otf', __pad_jpeg)
@@ -5,11 +5,116 @@ of web pages (e.g.: text, images).
 """
 import os
 import page
+import logging
+import metrics
+import multiprocessing
 import numpy as np
+from array import array
+from bisect import bisect_left
+from multiprocessing.pool import ThreadPool
 from file_utils import *
-from morph_utils import create_object, morph_html, morph_object
+from morph_utils import create_object, html_parts, min_padding, morph_object
+from morph_utils import write_parts, HTML_COMMENT
 
-def morph_page_distribution(fname, page_sampler, outdir):
+logger = logging.getLogger(__name__)
+
+class MorphingError(Exception):
+    """Raised when a page cannot be morphed into the target sizes.
+    """
+    pass
+
+class HTMLSizeError(MorphingError):
+    """Raised when the HTML page (with the references to the padding
+    objects) does not fit into the target HTML size.
+    """
+    pass
+
+class ObjectPaddingError(MorphingError):
+    """Raised when an object cannot be padded to its target size
+    (the padding is smaller than its padder's minimum).
+
+    Attributes
+    ----------
+    index : int
+        Index of the object in the objects of the page.
+    size : int
+        Target size of the object.
+    """
+
+    def __init__(self, message, index, size):
+        super(ObjectPaddingError, self).__init__(message)
+        self.index = index
+        self.size = size
+
+class MorphPlan(object):
+    """How to morph a page.
+
+    A plan is computed without touching the disk (see plan_morph
+    and the plan_page_* functions), and applied by execute_plan.
+    It only refers to files by name, so it can be stored, cached
+    or applied on another machine.
+
+    Attributes
+    ----------
+    fname : str
+        File name of the HTML file of the original page.
+    target_html_size : int
+        Size of the morphed HTML page.
+    body : int
+        Offset of </body> in the HTML page.
+    sources : list of str
+        File names of the objects to morph.
+    paths : list of str
+        Paths (relative to the page) of the objects to morph.
+    sizes : array of int
+        Target size of each object to morph.
+    padding : array of int
+        Size of each padding object.
+    add_to_html : str
+        References to the padding objects, added to the HTML page.
+    padding_name : str
+        Prefix of the names of the padding objects.
+    variants : list of bool
+        Whether each object to morph is a content-addressed variant
+        (see plan_morph), which only needs to be written once.
+    rewrites : list of (int, int, str)
+        Rewrites of the HTML page (start, end, text) pointing its
+        references to the variants.
+    """
+    __slots__ = ('fname', 'target_html_size', 'body', 'sources', 'paths',
+                 'sizes', 'padding', 'add_to_html', 'padding_name',
+                 'variants', 'rewrites')
+
+    def __init__(self, fname, target_html_size, body, sources, paths, sizes,
+                 padding, add_to_html, padding_name='rnd', variants=None,
+                 rewrites=()):
+        self.fname = fname
+        self.target_html_size = int(target_html_size)
+        self.body = body
+        self.sources = sources
+        self.paths = paths
+        self.sizes = array('l', sizes)
+        self.padding = array('l', padding)
+        self.add_to_html = add_to_html
+        self.padding_name = padding_name
+        self.variants = variants or [False] * len(sources)
+        self.rewrites = list(rewrites)
+
+    def padding_paths(self):
+        """Paths (relative to the page) of the padding objects.
+        """
+        return [_padding_path(i, self.padding_name)
+                for i in range(len(self.padding))]
+
+    def __getstate__(self):
+        return tuple(getattr(self, k) for k in self.__slots__)
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
+def morph_page_distribution(fname, page_sampler, outdir, workers=1,
+                            processes=False, max_attempts=100):
     """Morph original page to look as it comes from the
     specified distribution.
 
@@ -21,8 +126,44 @@ def morph_page_distribution(fname, page_sampler, outdir):
         Page sampler.
     outdir : str
         Destination directory.
+    workers : int (Default: 1)
+        Number of objects morphed in parallel.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
+    max_attempts : int (Default: 100)
+        Maximum number of samples tried.
+    """
+    plan = plan_page_distribution(fname, page_sampler, max_attempts)
+    execute_plan(plan, outdir, workers, processes)
+
+def plan_page_distribution(fname, page_sampler, max_attempts=100, root=None,
+                           padding_name='rnd', variants=False):
+    """Plan how to morph original page to look as it comes from
+    the specified distribution.
+
+    Target sizes are sampled until the page fits into them.
+
+    Parameters
+    ----------
+    fname : str
+        File name of the HTML file of the original page.
+    page_sampler : sampling.PageSampler
+        Page sampler.
+    max_attempts : int (Default: 100)
+        Maximum number of samples tried.
+    root : str (Default: None)
+        Document root (see page.Page).
+    padding_name : str (Default: 'rnd')
+        Prefix of the names of the padding objects.
+    variants : bool (Default: False)
+        Morph objects into content-addressed variants (see plan_morph).
+
+    Returns
+    -------
+    plan : MorphPlan
+        The plan.
     """
-    original = page.Page(fname)
+    original = page.cached_page(fname, root)
     html_size = original.html['size']
     sizes = original.get_sizes()
     number = len(sizes)                 # Number of objects.
@@ -32,21 +173,26 @@ def morph_page_distribution(fname, page_sampler, outdir):
     else:
         min_objs = min(sizes)
 
-    target_html_size, target_sizes = page_sampler.sample_page(min_count = number,
-                                                              min_html = html_size,
-                                                              min_objs = min_objs)
-                                                            
-    # Try to morph. If it doesn't work (some sizes where too
-    # small), notify and try again.
-    try:
-        morph_page(original, target_html_size, target_sizes, outdir)
-    except NotImplementedError as e:
-        raise e
-    except:
-        print "Couldn't morph {} with {}".format(sizes, target_sizes)
-        morph_page_distribution(fname, page_sampler, outdir)
-
-def morph_page_target(fname, target_html_size, target_sizes, outdir):
+    for attempt in range(max_attempts):
+        with metrics.timer('sample'):
+            target_html_size, target_sizes = page_sampler.sample_page(min_count = number,
+                                                                      min_html = html_size,
+                                                                      min_objs = min_objs)
+        # If the page doesn't fit (some sizes where too small),
+        # notify and try again.
+        try:
+            with metrics.timer('plan'):
+                return plan_morph(original, target_html_size, target_sizes,
+                                  padding_name, variants)
+        except MorphingError:
+            metrics.count('retries')
+            logger.debug("Couldn't morph %s with %s", sizes, target_sizes)
+
+    raise MorphingError("Couldn't morph {} in {} attempts.".format(
+                        fname, max_attempts))
+
+def morph_page_target(fname, target_html_size, target_sizes, outdir,
+                      workers=1, processes=False):
     """Morph original page to look like a target, and put
     the morphed content in outdir directory.
     
@@ -60,21 +206,101 @@ def morph_page_target(fname, target_html_size, target_sizes, outdir):
         Sizes of the objects of the target page.
     outdir : string
         Output directory.
+    workers : int (Default: 1)
+        Number of objects morphed in parallel.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
     """
-    original = page.Page(fname)
-    morph_page(original, target_html_size, target_sizes, outdir)
+    plan = plan_page_target(fname, target_html_size, target_sizes)
+    execute_plan(plan, outdir, workers, processes)
+
+def plan_page_target(fname, target_html_size, target_sizes, root=None,
+                     padding_name='rnd', variants=False):
+    """Plan how to morph original page to look like a target.
+    
+    Parameters
+    ----------
+    fname : string
+        File name of the HTML file of the original page.
+    target_html_size : int
+        Size of the HTML file of the target page.
+    target_sizes : list of int
+        Sizes of the objects of the target page.
+    root : str (Default: None)
+        Document root (see page.Page).
+    padding_name : str (Default: 'rnd')
+        Prefix of the names of the padding objects.
+    variants : bool (Default: False)
+        Morph objects into content-addressed variants (see plan_morph).
+
+    Returns
+    -------
+    plan : MorphPlan
+        The plan.
+    """
+    original = page.cached_page(fname, root)
+
+    with metrics.timer('plan'):
+        return plan_morph(original, target_html_size, target_sizes,
+                          padding_name, variants)
 
 def _next_multiple(x, m):
     """Returns k*m, where k is the smallest int for which x <= m*k.
     """
     assert m > 0
-    k = 1
-    while k*m < x:
-        k += 1
 
-    return k*m
+    return max(1, -(-x // m)) * m
+
+def _next_multiples(x, m):
+    """Vectorised _next_multiple over the array x.
+    """
+    assert m > 0
+    x = np.asarray(x, dtype=np.int64)
+
+    return np.maximum(1, -(-x // m)) * m
+
+def deterministic_targets(html_size, sizes, S, L, max_S):
+    """Computes the target sizes of a page morphed with D-ALPaCA.
+
+    The number of objects is padded to the next multiple of L,
+    the size of the HTML page and of each object to the next
+    multiple of S. The sizes of new objects are drawn uniformly
+    in [S, 2S, ..., max_S].
 
-def morph_page_deterministic(fname, S, L, max_S, outdir):
+    Parameters
+    ----------
+    html_size : int
+        Size of the HTML page.
+    sizes : list of int
+        Sizes of the objects.
+    S : int
+        Size parameter.
+    L : int
+        Length (number of objects) parameter.
+    max_S : int
+        Must be a multiple of S.
+
+    Returns
+    -------
+    target_html_size : int
+        Size of the morphed HTML page.
+    target_sizes : list of int
+        Sizes of the morphed objects, followed by the sizes of
+        the new objects.
+    """
+    if max_S % S != 0:
+        raise Exception('max_S should be a multiple of S.')
+    target_number = _next_multiple(len(sizes), L)
+    target_html_size = _next_multiple(html_size, S)
+    target_sizes = _next_multiples(sizes, S)
+    new_sizes = S * np.random.randint(1, max_S // S + 1,
+                                      size=target_number - len(sizes))
+
+    return target_html_size, np.concatenate((target_sizes, new_sizes)).tolist()
+
+def morph_page_deterministic(fname, S, L, max_S, outdir, workers=1,
+                             processes=False, max_attempts=100,
+                             padding_pool=None):
     """Morph original page to contain a multiple of L objects,
     each of them with size multiple of S.
     Parameters
@@ -91,41 +317,90 @@ def morph_page_deterministic(fname, S, L, max_S, outdir):
         Must be a multiple of S.
         If new objects are created, their sizes are sampled
         uniformly in [S, 2S, ..., max_S].
+    workers : int (Default: 1)
+        Number of objects morphed in parallel.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
+    max_attempts : int (Default: 100)
+        Maximum number of HTML and object sizes tried.
+    padding_pool : str (Default: None)
+        Directory of a pool of padding blobs (see
+        morph_utils.create_object). Padding objects only take a few
+        sizes with D-ALPaCA, so that they are mostly links.
+    """
+    plan = plan_page_deterministic(fname, S, L, max_S, max_attempts)
+    execute_plan(plan, outdir, workers, processes, padding_pool)
+
+def plan_page_deterministic(fname, S, L, max_S, max_attempts=100,
+                            root=None, padding_name='rnd', variants=False):
+    """Plan how to morph original page to contain a multiple of
+    L objects, each of them with size multiple of S.
+
+    Parameters
+    ----------
+    fname : string
+        File name of the HTML file of the original page.
+    S : int
+        Size parameter.
+    L : int
+        Length (number of objects) parameters.
+    max_S : int
+        Must be a multiple of S.
+        If new objects are created, their sizes are sampled
+        uniformly in [S, 2S, ..., max_S].
+    max_attempts : int (Default: 100)
+        Maximum number of HTML and object sizes tried.
+    root : str (Default: None)
+        Document root (see page.Page).
+    padding_name : str (Default: 'rnd')
+        Prefix of the names of the padding objects.
+    variants : bool (Default: False)
+        Morph objects into content-addressed variants (see plan_morph).
+
+    Returns
+    -------
+    plan : MorphPlan
+        The plan.
     """
     if max_S % S != 0:
         raise Exception('max_S should be a multiple of S.')
-    original = page.Page(fname)
+    original = page.cached_page(fname, root)
     original_html_size = original.html['size']
-    original_sizes = original.get_sizes()
-    original_number = len(original_sizes)
-    # Pad total length to next multiple of L.
-    target_number = _next_multiple(original_number, L)
-    # Pad the size of each object to the next multiple
-    # of S.
-    target_html_size = _next_multiple(original_html_size, S)
-    target_sizes = []
-    for s in original_sizes:
-        t = _next_multiple(s, S)
-        target_sizes.append(t)
-    # Create remaining objects.
-    sizes = range(0, max_S+1, S)            # Possible size for new objects.
-    del sizes[0]                            # Remove size 0.
-    for i in range(target_number - len(target_sizes)):
-        s = np.random.choice(sizes)
-        target_sizes.append(s)
+    target_html_size, target_sizes = deterministic_targets(original_html_size,
+                                                           original.get_sizes(),
+                                                           S, L, max_S)
 
-    try:
-        morph_page(original, target_html_size, target_sizes, outdir)
-    except:
-        # This can happen if original_html_size and target_html_size are
-        # close. This means that when adding stuff to the mophed html page
-        # (e.g., image references) the page may become bigger than target_html_size,
-        # which makes morphing fail.
-        print "Couldn't morph {} with {}".format(original_html_size, target_html_size)
-        target_html_size += S
-        morph_page(original, target_html_size, target_sizes, outdir)
-
-def morph_page(original, target_html_size, target_sizes, outdir):
+    for attempt in range(max_attempts):
+        try:
+            with metrics.timer('plan'):
+                return plan_morph(original, target_html_size, target_sizes,
+                                  padding_name, variants)
+        except HTMLSizeError:
+            # This can happen if original_html_size and target_html_size are
+            # close. This means that when adding stuff to the mophed html page
+            # (e.g., image references) the page may become bigger than
+            # target_html_size, which makes morphing fail.
+            metrics.count('retries')
+            logger.debug("Couldn't morph %s with %s", original_html_size,
+                         target_html_size)
+            target_html_size += S
+        except ObjectPaddingError as e:
+            # The object is just below a multiple of S, and cannot be
+            # padded by so few bytes: pad it to the next multiple.
+            metrics.count('retries')
+            logger.debug("Couldn't pad object %d to %d", e.index, e.size)
+            k = e.index
+            if target_sizes[k] != e.size:
+                # The object was matched with another target of the
+                # same size.
+                k = target_sizes.index(e.size)
+            target_sizes[k] += S
+
+    raise MorphingError("Couldn't morph {} in {} attempts.".format(
+                        fname, max_attempts))
+
+def morph_page(original, target_html_size, target_sizes, outdir, workers=1,
+               processes=False):
     """Morph original page to look like a target, and put
     the morphed content in outdir directory.
     
@@ -139,49 +414,219 @@ def morph_page(original, target_html_size, target_sizes, outdir):
         Sizes of the objects of the target page.
     outdir : string
         Output directory.
+    workers : int (Default: 1)
+        Number of objects morphed in parallel.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
     """
-    # Which object should be morphed with what.
-    original_sizes = original.get_sizes()
-    pairs, remainders = match_sizes(original_sizes, target_sizes)
+    plan = plan_morph(original, target_html_size, target_sizes)
+    execute_plan(plan, outdir, workers, processes)
+
+def execute_plan(plan, outdir, workers=1, processes=False, padding_pool=None):
+    """Morph a page as described by plan, and put the morphed
+    content in outdir directory.
 
+    Objects are morphed (and padding objects created) by a pool
+    of threads or processes; the HTML page is morphed once
+    all of them are done.
+
+    Parameters
+    ----------
+    plan : MorphPlan
+        The plan.
+    outdir : string
+        Output directory.
+    workers : int (Default: 1)
+        Number of objects morphed in parallel.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
+    padding_pool : str (Default: None)
+        Directory of a pool of padding blobs, which padding objects
+        are linked to (see morph_utils.create_object).
+    """
     # Morph objects.
-    original_objects = original.objects
-    for i, size in pairs:
-        src = original_objects[i]['fullpath']
-        src_relative = original_objects[i]['path']
-        print 'Morphing {} to size {}.'.format(src_relative, size)
+    jobs = []
+    for src, src_relative, size, variant in zip(plan.sources, plan.paths,
+                                                plan.sizes, plan.variants):
         dst = os.path.join(outdir, src_relative)
+        # Variants are named after their content and size: existing
+        # ones need not be written again.
+        if variant and os.path.exists(dst):
+            metrics.count('variants_reused')
+            continue
+        logger.debug('Morphing %s to size %s.', src_relative, size)
         make_path(dst)
-        #print 'Full: {}, relative: {}'.format(src, src_relative)
-        morph_object(src, dst, size)
+        jobs.append((_morph_object, (src, dst, size)))
+        metrics.count('objects_morphed')
+        metrics.count('bytes_padded', size - file_size(src))
 
     # Add padding objects.
-    add_to_html = ''
-    for i, size in enumerate(remainders):
-        dst = os.path.join(outdir, 'random-objects', 'rnd-{}.png'.format(i))
-        dst_relative = os.path.join('random-objects', 'rnd-{}.png'.format(i))
-        print 'Adding {} with size {}.'.format(dst, size)
+    for path, size in zip(plan.padding_paths(), plan.padding):
+        dst = os.path.join(outdir, path)
+        logger.debug('Adding %s with size %s.', dst, size)
         make_path(dst)
-        create_object(dst, size)
-        add_to_html += '<img src="{}" style="visibility:hidden">'.format(dst_relative)
-
-    # Morph HTML page.
-    if original.html['size'] + len(add_to_html) > target_html_size:
-        raise Exception('The size of the original page is larger than the target one.')
-    with open(original.fname) as f:
-        original_html = f.read()
-    # Put add_to_html (links to padding images) right before the end of
-    # <body>.
-    body = original_html.find('</body>')
-    if body == -1:
-        raise Exception('Am I really looking at an HTML file?')
-    tmp = original_html[:body] + add_to_html + original_html[body:]
-    new_html = morph_html(tmp, target_html_size)
-    dst = os.path.join(outdir, file_name(original.fname))
-    print 'Morphing {} to size {}.'.format(dst, target_html_size)
+        jobs.append((_create_object, (dst, size, padding_pool)))
+        metrics.count('padding_objects')
+        metrics.count('padding_bytes', size)
+    run_jobs(jobs, workers, processes)
+
+    # Morph HTML page: put add_to_html (links to padding images) right
+    # before the end of <body>, and point references to the variants.
+    dst = os.path.join(outdir, file_name(plan.fname))
+    logger.info('Morphing %s to size %s.', dst, plan.target_html_size)
     make_path(dst)
-    with open(dst, 'w') as f:
-        f.write(new_html)
+    with metrics.timer('html'):
+        write_parts(html_parts(plan.fname, plan.body, plan.add_to_html,
+                               plan.target_html_size, plan.rewrites), dst)
+    metrics.count('pages_morphed')
+
+def _morph_object(src, dst, size):
+    with metrics.timer('pad'):
+        morph_object(src, dst, size)
+
+def _create_object(dst, size, padding_pool):
+    with metrics.timer('pad'):
+        create_object(dst, size, padding_pool)
+
+def plan_morph(original, target_html_size, target_sizes, padding_name='rnd',
+               variants=False):
+    """Plan how to morph original page into the target sizes,
+    without writing any file.
+
+    With variants, each object referenced by the HTML page only is
+    morphed into a content-addressed variant, next to the original
+    and named after the digest of its content and its target size
+    (see _variant_path), and the references of the page are rewritten
+    to point to it. Objects shared by many pages are thus morphed
+    once per target size, and pages do not overwrite each other's.
+
+    Parameters
+    ----------
+    original : Page instance
+        Original page to morph.
+    target_html_size : int
+        Size of the HTML file of the target page.
+    target_sizes : list of int
+        Sizes of the objects of the target page.
+    padding_name : str (Default: 'rnd')
+        Prefix of the names of the padding objects. Pages morphed
+        into the same directory need different prefixes.
+    variants : bool (Default: False)
+        Morph objects into content-addressed variants.
+
+    Returns
+    -------
+    plan : MorphPlan
+        The plan.
+
+    Raises
+    ------
+    MorphingError
+        If the page does not fit into the target sizes: either
+        HTMLSizeError (the HTML page is too large) or
+        ObjectPaddingError (an object cannot be padded to its target
+        size).
+    """
+    if original.body is None:
+        raise Exception('Am I really looking at an HTML file?')
+    original_objects = original.objects
+    # Which object should be morphed with what.
+    pairs, remainders = match_sizes(original.get_sizes(), target_sizes)
+    for i, size in pairs:
+        pad = size - original_objects[i]['size']
+        if 0 < pad < min_padding(original_objects[i]['path']):
+            raise ObjectPaddingError('Cannot pad {} with {} bytes.'.format(
+                                     original_objects[i]['path'], pad),
+                                     i, size)
+    if [size for size in remainders if size <= 0]:
+        raise MorphingError('Padding objects must have a positive size.')
+
+    objects = [original_objects[i] for i, size in pairs]
+    paths = [obj['path'] for obj in objects]
+    is_variant = [False] * len(objects)
+    rewrites = []
+    if variants:
+        for k, (obj, (i, size)) in enumerate(zip(objects, pairs)):
+            if obj['name_spans'] is None:
+                continue
+            paths[k] = _variant_path(obj, size)
+            is_variant[k] = True
+            name = file_name(paths[k])
+            rewrites += [(start, end, name)
+                         for start, end in obj['name_spans']]
+
+    add_to_html = ''.join(_padding_html(_padding_path(i, padding_name))
+                          for i in range(len(remainders)))
+    # The HTML page is padded with a comment.
+    html_size = original.html['size'] + len(add_to_html)
+    html_size += sum(len(text) - (end - start)
+                     for start, end, text in rewrites)
+    comment = len(HTML_COMMENT[0]) + len(HTML_COMMENT[1])
+    if html_size != target_html_size and html_size + comment > target_html_size:
+        raise HTMLSizeError('The size of the original page is larger than ' +
+                            'the target one.')
+
+
+    return MorphPlan(original.fname, target_html_size, original.body,
+                     [obj['fullpath'] for obj in objects], paths,
+                     [size for i, size in pairs],
+                     remainders, add_to_html, padding_name, is_variant,
+                     rewrites)
+
+def _variant_path(obj, size):
+    """Path (relative to the page) of the variant of obj padded
+    to size: <dir>/<name>.<digest>-<size>.<ext>.
+
+    Variants are in the same directory as the original, so that
+    the relative URLs they contain (e.g., in CSS) still resolve.
+    """
+    digest = cached_digest(obj['fullpath'], obj['stat'])
+    base, ext = os.path.splitext(obj['path'])
+
+    return '{}.{}-{}{}'.format(base, digest[:8], size, ext)
+
+def _padding_path(i, name='rnd'):
+    """Path (relative to the page) of the i-th padding object.
+    """
+    return os.path.join('random-objects', '{}-{}.png'.format(name, i))
+
+def _padding_html(path):
+    """HTML referencing a padding object.
+    """
+    return '<img src="{}" style="visibility:hidden">'.format(path)
+
+def run_jobs(jobs, workers=1, processes=False):
+    """Run jobs, possibly in parallel.
+
+    All the jobs are run to completion; if some of them failed,
+    the exception of the first one that failed (in the order of
+    jobs) is raised.
+
+    Parameters
+    ----------
+    jobs : list of (function, tuple)
+        Functions to call, with their arguments.
+    workers : int (Default: 1)
+        Number of jobs run in parallel.
+    processes : bool (Default: False)
+        Run jobs in a pool of processes rather than threads.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        for f, args in jobs:
+            f(*args)
+        return
+    if processes:
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = ThreadPool(workers)
+    try:
+        results = [pool.apply_async(f, args) for f, args in jobs]
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    for r in results:
+        r.get()
 
 def match_sizes(original_sizes, target_sizes):
     """Decide which original size should be paded with which
@@ -198,19 +643,26 @@ def match_sizes(original_sizes, target_sizes):
     oi = sorted(range(len(original_sizes)), key=lambda x: original_sizes[x])
     ts = sorted(target_sizes)
 
+    # Match each original size (from the smallest) with the smallest
+    # target size that fits it, among the ones not considered yet.
     pairs = []
-    remainders = [x for x in target_sizes]
-
+    used = {}
+    j = 0
     for i in oi:
-        for j in range(len(ts)):
-            size = ts[j]
-            if original_sizes[i] <= size:
-               pairs.append((i, size))
-               remainders.remove(size)
-               # Remove previous j sizes
-               ts = ts[j+1:]
-               break
+        j = bisect_left(ts, original_sizes[i], j)
+        if j == len(ts):
+            raise MorphingError('Original page > Target page.')
+        size = ts[j]
+        pairs.append((i, size))
+        used[size] = used.get(size, 0) + 1
+        j += 1
+
+    # Unmatched target sizes, in their original order.
+    remainders = []
+    for size in target_sizes:
+        if used.get(size):
+            used[size] -= 1
         else:
-            raise Exception('Original page > Target page.')
+            remainders.append(size)
 
     return pairs, remainders
@@ -1,9 +1,37 @@
-from bs4 import BeautifulSoup
+import re
+import logging
+import metrics
+import threading
+from collections import OrderedDict
 from file_utils import *
+from morph_utils import can_pad
+try:
+    from HTMLParser import HTMLParser
+    from urllib import unquote
+except ImportError:
+    from html.parser import HTMLParser
+    from urllib.parse import unquote
+
+# Attributes in the raw text of a start tag (same as HTMLParser).
+ATTRIBUTE = re.compile(r"""((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*""" +
+                       r"""(\'[^\']*\'|"[^"]*"|(?!['"])[^>\s]*))?""")
+# References in CSS text.
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+CSS_URL = re.compile(r"""url\(\s*(?:"([^"]*)"|'([^']*)'|([^)\s]*))\s*\)""",
+                     re.I)
+CSS_IMPORT = re.compile(r"""@import\s+(?:"([^"]*)"|'([^']*)')""", re.I)
+# URLs that do not refer to a local file.
+EXTERNAL_URL = re.compile(r'^([a-zA-Z][a-zA-Z0-9+.-]*:|//|#)')
+# Values of <link rel> referencing objects loaded by the browser
+# (other than stylesheets).
+LINK_RELS = set(['icon', 'apple-touch-icon', 'preload', 'modulepreload',
+                 'prefetch'])
+
+logger = logging.getLogger(__name__)
 
 class Page:
     
-    def __init__(self, page):
+    def __init__(self, page, root=None):
         """Instantiate a Page object, given the file name
         of an HTML page.
         
@@ -11,14 +39,43 @@ class Page:
         ----------
         page : string
             File name of HTML page.
+        root : string (Default: None)
+            Document root, used to resolve paths starting with '/'.
+            If None, such paths are ignored.
         """
         self.fname = page
+        self.root = root
         self.basedir = dir_name(page)
         relpath = file_name(page)
         self.html = self.new_object(relpath, 'html')
+        # Offset of </body> in the HTML page.
+        self.body = None
+        # Referenced files that do not exist.
+        self.missing = set()
+        # Referenced files that cannot be padded (see
+        # morph_utils.register_padder).
+        self.unpadded = set()
         with open(page) as f:
             self.objects = self.parse_objects(f.read())
 
+    def signature(self):
+        """Return the signature (see file_signature) of the HTML
+        page and of the objects when the page was parsed.
+        """
+        return ([(self.html['fullpath'], self.html['stat'])] +
+                [(x['fullpath'], x['stat']) for x in self.objects] +
+                [(x, None) for x in sorted(self.missing)])
+
+    def is_current(self):
+        """Return True if the HTML page and its objects did not
+        change since the page was parsed.
+        """
+        for fullpath, stat in self.signature():
+            if file_signature(fullpath) != stat:
+                return False
+
+        return True
+
     def get_sizes(self):
         """Return the size of the objects.
         
@@ -28,37 +85,389 @@ class Page:
     def parse_objects(self, html):
         """Return the path to the objects of an html page.
 
+        Objects are the images (<img src/srcset>, <source srcset>),
+        stylesheets, scripts, icons and preloaded resources referenced
+        by the page, and the resources referenced by its CSS (url(),
+        @import), following stylesheets recursively. Each file is
+        read once, and appears once in the objects, whatever the
+        number of references to it. References to external URLs are
+        ignored; references to missing files, and to files that
+        cannot be padded, are ignored with a warning.
+
+        Each object records the offset of the first tag referencing
+        it ('offset', None if referenced by CSS only), and the span of
+        the attribute value containing its path for each reference
+        ('spans'; None for references that are not in an attribute,
+        e.g. in CSS), and the spans of its file name in these
+        references ('name_spans'; None if some reference cannot be
+        rewritten, see name_spans). Also sets the offset of </body>
+        (self.body).
+
         Parameters
         ----------
         html : string
-            HTML page.
+            HTML page (bytes).
         """
-        soup = BeautifulSoup(html, 'html.parser')
-        # Images
-        links = soup.find_all('img', src=True)
+        scanner = ObjectScanner()
+        # HTMLParser unescapes attributes into unicode, which fails on
+        # non-ASCII bytes if the text is not unicode. Latin-1 maps
+        # each byte onto one character: offsets are byte offsets, and
+        # URLs are encoded back into the original bytes.
+        scanner.scan(html.decode('latin-1'))
+        self.body = scanner.body
         objects = []
-        for img in links:
-            path = img['src']
-            obj = self.new_object(path)
-            objects.append(obj)
-        # CSS
-        links = soup.find_all('link', rel='stylesheet')
-        for css in links:
-            path = css['href']
-            obj = self.new_object(path)
-            objects.append(obj)
+        index = {}
+        # Images first, then CSS, then other objects.
+        refs = scanner.images + scanner.stylesheets + scanner.others
+        for text in scanner.styles:
+            refs += [(url, None, None) for url in css_references(text)]
+        for url, offset, span in refs:
+            try:
+                url = url.encode('latin-1')
+            except UnicodeEncodeError:
+                # An entity outside Latin-1: not a local file name.
+                continue
+            self._add_object(objects, index, self._html_path(url), offset, span)
+        # Follow stylesheets.
+        queue = [obj for obj in objects if obj['type'] == 'css']
+        while queue:
+            css = queue.pop()
+            with open(css['fullpath']) as f:
+                urls = css_references(f.read())
+            for url in urls:
+                obj = self._add_object(objects, index, self._css_path(css, url))
+                if obj is not None and obj['type'] == 'css':
+                    queue.append(obj)
+        for obj in objects:
+            obj['name_spans'] = name_spans(html, obj)
 
         return objects
 
+    def _add_object(self, objects, index, path, offset=None, span=None):
+        """Adds the object at path (relative to the page) to objects,
+        unless it is already there (in which case only the span
+        is recorded).
+
+        Returns the new object, or None.
+        """
+        if path is None:
+            return None
+        fullpath = os.path.normpath(os.path.join(self.basedir, path))
+        if fullpath in index:
+            index[fullpath]['spans'].append(span)
+            return None
+        if fullpath in self.missing or fullpath in self.unpadded:
+            return None
+        if not os.path.isfile(fullpath):
+            logger.warning('%s: %s does not exist.', self.fname, fullpath)
+            self.missing.add(fullpath)
+            return None
+        if not can_pad(fullpath):
+            logger.warning('%s: %s cannot be padded, and is left as is.',
+                           self.fname, fullpath)
+            self.unpadded.add(fullpath)
+            return None
+        obj = self.new_object(path)
+        obj['offset'] = offset
+        obj['spans'] = [span]
+        objects.append(obj)
+        index[fullpath] = obj
+
+        return obj
+
+    def _html_path(self, url):
+        """Path (relative to the page) of an URL found in the page.
+        """
+        url = local_url(url)
+        if url is None or not url.startswith('/'):
+            return url
+        if self.root is None:
+            return None
+
+        return self._relative(os.path.join(self.root, url.lstrip('/')))
+
+    def _css_path(self, css, url):
+        """Path (relative to the page) of an URL found in a CSS file.
+        """
+        url = local_url(url)
+        if url is None:
+            return None
+        if url.startswith('/'):
+            return self._html_path(url)
+
+        return self._relative(os.path.join(dir_name(css['fullpath']), url))
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.basedir or os.curdir)
+
     def new_object(self, path, ftype=None, delay=0):
         
         fullpath = os.path.join(self.basedir, path)
-        size = file_size(fullpath)
+        stat = file_signature(fullpath)
+        if stat is None:
+            raise OSError('No such file: {}'.format(fullpath))
         if not ftype:
             ftype = file_extension(path)
         
         return {'path': path,
                 'fullpath': fullpath,
-                'size': size,
+                'size': stat[1],
                 'type': ftype,
-                'delay': delay}
+                'delay': delay,
+                'stat': stat}
+
+class PageCache(object):
+    """LRU cache of parsed pages.
+
+    A cached page is only returned if its HTML file and all its
+    objects still have the same mtime, size and inode (and missing
+    objects are still missing); otherwise, the page is parsed again.
+    Cached pages are shared, and must not be modified.
+
+    Parameters
+    ----------
+    capacity : int (Default: 128)
+        Maximum number of pages kept.
+    """
+
+    def __init__(self, capacity=128):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, fname, root=None):
+        """Return the Page of HTML file fname.
+
+        Parameters
+        ----------
+        fname : string
+            File name of HTML page.
+        root : string (Default: None)
+            Document root (see Page).
+        """
+        key = (os.path.abspath(fname), root)
+        with self._lock:
+            page = self._pages.pop(key, None)
+        if page is not None:
+            if page.is_current():
+                with self._lock:
+                    self.hits += 1
+                    self._pages[key] = page
+                return page
+            with self._lock:
+                self.invalidations += 1
+        with metrics.timer('parse'):
+            page = Page(fname, root)
+        with self._lock:
+            self.misses += 1
+            self._pages[key] = page
+            while len(self._pages) > self.capacity:
+                self._pages.popitem(last=False)
+
+        return page
+
+    def clear(self):
+        """Remove all the pages.
+        """
+        with self._lock:
+            self._pages.clear()
+
+    def stats(self):
+        """Return hits, misses, invalidations, and number of pages.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'invalidations': self.invalidations,
+                    'pages': len(self._pages)}
+
+# Process-wide cache of pages.
+cache = PageCache()
+
+def cached_page(fname, root=None):
+    """Return the Page of HTML file fname from the process-wide cache.
+    """
+    return cache.get(fname, root)
+
+def local_url(url):
+    """Returns the (percent-decoded) path of a local URL, without
+    query and fragment, or None if the URL refers to an external
+    resource.
+    """
+    url = (url or '').strip()
+    if not url or EXTERNAL_URL.match(url):
+        return None
+    url = unquote(url.split('#', 1)[0].split('?', 1)[0])
+
+    return url or None
+
+def name_spans(html, obj):
+    """Returns the spans (start, end) of the file name of obj in its
+    references in html, so that they can be rewritten to refer to
+    another file in the same directory.
+
+    Returns None if some reference cannot be rewritten (e.g., it is
+    in CSS, or the file name is escaped).
+    """
+    old = file_name(obj['path'])
+    spans = []
+    for span in obj['spans']:
+        if span is None:
+            return None
+        start, end = span
+        url = html[start:end]
+        # Drop query and fragment.
+        end = start + len(url.split('#', 1)[0].split('?', 1)[0])
+        begin = end - len(old)
+        if begin < start or html[begin:end] != old or \
+                (begin > start and html[begin - 1] != '/'):
+            return None
+        spans.append((begin, end))
+
+    return spans
+
+def css_references(text):
+    """Returns the URLs referenced (url(), @import) in CSS text.
+    """
+    text = CSS_COMMENT.sub('', text)
+    urls = []
+    for regex in (CSS_IMPORT, CSS_URL):
+        for m in regex.finditer(text):
+            urls.append(m.group(1) or m.group(2) or m.group(3) or '')
+
+    return urls
+
+class ObjectScanner(HTMLParser):
+    """Collects the objects referenced by an HTML page.
+
+    Offsets are positions in the scanned text.
+
+    Attributes
+    ----------
+    images : list of (str, int, (int, int))
+        URL of each image (<img src/srcset>, <source srcset>),
+        offset of its tag, and span of the URL in the text.
+    stylesheets : list of (str, int, (int, int))
+        Same, for <link rel="stylesheet">.
+    others : list of (str, int, (int, int))
+        Same, for scripts and other <link>s (icons, preloads).
+    styles : list of str
+        CSS text in the page (<style> and style attributes).
+    body : int
+        Offset of the first </body> tag (None if missing).
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.images = []
+        self.stylesheets = []
+        self.others = []
+        self.styles = []
+        self.body = None
+        self._lines = [0]
+        self._in_style = False
+
+    def scan(self, html):
+        """Scans html text.
+        """
+        self._lines = [0]
+        start = html.find('\n')
+        while start != -1:
+            self._lines.append(start + 1)
+            start = html.find('\n', start + 1)
+        self.feed(html)
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if attrs.get('style'):
+            self.styles.append(attrs['style'])
+        if tag == 'img':
+            if 'src' in attrs:
+                self.images.append(self._reference('src', attrs))
+            self.images.extend(self._srcset(attrs))
+        elif tag == 'source':
+            # Only <picture> sources (srcset); media sources are
+            # not padded.
+            self.images.extend(self._srcset(attrs))
+        elif tag == 'link' and 'href' in attrs:
+            rel = (attrs.get('rel') or '').lower().split()
+            if 'stylesheet' in rel:
+                self.stylesheets.append(self._reference('href', attrs))
+            elif LINK_RELS.intersection(rel):
+                self.others.append(self._reference('href', attrs))
+        elif tag == 'script' and attrs.get('src'):
+            self.others.append(self._reference('src', attrs))
+        elif tag == 'style':
+            self._in_style = True
+
+    def handle_endtag(self, tag):
+        if tag == 'body' and self.body is None:
+            self.body = self._offset()
+        elif tag == 'style':
+            self._in_style = False
+
+    def handle_data(self, data):
+        if self._in_style:
+            self.styles.append(data)
+
+    def _offset(self):
+        """Offset of the current tag.
+        """
+        line, col = self.getpos()
+
+        return self._lines[line-1] + col
+
+    def _span(self, name):
+        """Span (in the tag) of the raw value of attribute name of the
+        current tag.
+        """
+        span = None
+        for m in ATTRIBUTE.finditer(self.get_starttag_text()):
+            if m.group(1).lower() == name and m.group(3):
+                start, end = m.span(3)
+                if m.group(3)[:1] in '\'"':
+                    start, end = start + 1, end - 1
+                span = (start, end)
+
+        return span
+
+    def _reference(self, name, attrs):
+        """URL in attribute name, offset of the current tag, and
+        span of the attribute value.
+        """
+        offset = self._offset()
+        span = self._span(name)
+        if span is not None:
+            span = (offset + span[0], offset + span[1])
+
+        return attrs[name] or '', offset, span
+
+    def _srcset(self, attrs):
+        """URLs in the srcset attribute, offset of the current tag,
+        and span of each URL.
+        """
+        if not attrs.get('srcset'):
+            return []
+        offset = self._offset()
+        span = self._span('srcset')
+        raw = self.get_starttag_text()[span[0]:span[1]] if span else ''
+        refs = []
+        pos = 0
+        for candidate in attrs['srcset'].split(','):
+            candidate = candidate.split()
+            if not candidate:
+                continue
+            url = candidate[0]
+            # Locate the URL in the raw value (if not escaped).
+            start = raw.find(url, pos)
+            url_span = None
+            if start != -1:
+                pos = start + len(url)
+                url_span = (offset + span[0] + start, offset + span[0] + pos)
+            refs.append((url, offset, url_span))
+
+        return refs
@@ -1,5 +1,7 @@
-import pickle
+import threading
 import numpy as np
+from collections import deque, OrderedDict
+from kde_utils import read_kde, to_flat
 
 class PageSampler(object):
     """Samples size and number of objects in a page.
@@ -22,11 +24,57 @@ class PageSampler(object):
         """
         pass
 
+def sample_at_least(kde, n, min_value, block=64, max_block=65536):
+    """Draws n integer samples from kde that are at least min_value.
+
+    Equivalent to drawing one sample at a time and rejecting the
+    ones smaller than min_value, but samples are drawn in blocks:
+    the size of the next block is estimated from the acceptance
+    rate observed so far, so that only the shortfall is topped up.
+
+    Parameters
+    ----------
+    kde : sklearn.neighbors.KernelDensity
+        Fitted (one dimensional) KDE.
+    n : int
+        Number of samples.
+    min_value : int
+        Smallest value allowed.
+    block : int (Default: 64)
+        Minimum number of samples drawn at once.
+    max_block : int (Default: 65536)
+        Maximum number of samples drawn at once.
+
+    Returns
+    -------
+    samples : array of int
+        Array of n samples.
+    """
+    samples = []
+    found = 0
+    size = min(max(n, block), max_block)
+    while found < n:
+        s = kde.sample(size)[:, 0].astype(int)
+        s = s[s >= min_value]
+        samples.append(s)
+        found += len(s)
+        # Estimate how many samples are needed to fill the gap.
+        rate = max(len(s), 1) / float(size)
+        size = int((n - found) / rate * 1.2) + 1
+        size = min(max(size, block), max_block)
+
+    if not samples:
+        return np.zeros(0, dtype=int)
+
+    return np.concatenate(samples)[:n]
+
 class KDEIndividual(PageSampler):
 
-    def __init__(self, file_count, file_html, file_objs, random_state=0):
+    def __init__(self, file_count, file_html, file_objs, random_state=0,
+                 batch=True):
         super(self.__class__, self).__init__(random_state)
 
+        self.batch = batch
         self.count_kde = self.read_kde(file_count)
         self.html_kde = self.read_kde(file_html)
         self.objs_kde = self.read_kde(file_objs)
@@ -50,6 +98,13 @@ class KDEIndividual(PageSampler):
         objs_size : list of int
             Size of each object.
         """
+        if self.batch:
+            count = int(sample_at_least(self.count_kde, 1, min_count)[0])
+            html_size = int(sample_at_least(self.html_kde, 1, min_html)[0])
+            objs_size = sample_at_least(self.objs_kde, count, min_objs)
+
+            return html_size, [int(x) for x in objs_size]
+
         # Count.
         count = int(self.count_kde.sample(1)[0][0])
         while count < min_count:
@@ -69,8 +124,172 @@ class KDEIndividual(PageSampler):
         return html_size, objs_size
 
     def read_kde(self, fname):
-        with open(fname, 'rb') as f:
-            return pickle.load(f)
+        return read_kde(fname)
+
+class TruncatedKDE(object):
+    """One dimensional KDE that can be sampled above a lower bound.
+
+    The KDE is seen as a mixture of kernels centred on the (unique)
+    data points. For a lower bound, the mass of each kernel above
+    the bound is computed once and kept in a cumulative table; each
+    draw then picks a kernel by binary search on the table, and
+    samples the kernel truncated at the bound by inverse CDF.
+    Nothing is ever rejected, so the cost of a draw does not depend
+    on how far the bound is in the tail of the distribution.
+
+    Parameters
+    ----------
+    centers : array of float
+        Data points of the KDE.
+    bandwidth : float
+        Bandwidth of the kernel.
+    kernel : str (Default: 'gaussian')
+        Either 'gaussian' or 'tophat'.
+    weights : array of float (Default: None)
+        Weight of each data point.
+    min_mass : float (Default: 1e-12)
+        Smallest probability mass above a bound for it to be sampled.
+    """
+
+    KERNELS = ('gaussian', 'tophat')
+
+    def __init__(self, centers, bandwidth, kernel='gaussian', weights=None,
+                 min_mass=1e-12):
+        if kernel not in self.KERNELS:
+            raise Exception('Kernel {} not supported.'.format(kernel))
+        centers = np.asarray(centers, dtype=float).ravel()
+        if weights is None:
+            weights = np.ones(len(centers))
+        # Merge kernels with the same center.
+        self.centers, inverse = np.unique(centers, return_inverse=True)
+        self.weights = np.bincount(inverse, weights=weights)
+        self.weights /= self.weights.sum()
+        self.bandwidth = float(bandwidth)
+        self.kernel = kernel
+        self.min_mass = min_mass
+        self._tables = {}
+
+    @classmethod
+    def from_kde(cls, kde):
+        """Builds a TruncatedKDE from a FlatKDE or a fitted sklearn
+        KernelDensity.
+        """
+        kde = to_flat(kde)
+
+        return cls(kde.centers, kde.bandwidth, kde.kernel, kde.weights)
+
+    def sample(self, n, min_value=None):
+        """Draws n integer samples that are at least min_value.
+
+        Parameters
+        ----------
+        n : int
+            Number of samples.
+        min_value : int (Default: None)
+            Smallest value allowed.
+
+        Returns
+        -------
+        samples : array of int
+            Array of n samples.
+        """
+        if min_value is None:
+            low = -np.inf
+        elif min_value > 0:
+            low = float(min_value)
+        else:
+            # int() truncates towards 0: int(x) >= min_value iff
+            # x > min_value - 1.
+            low = float(min_value - 1)
+        mass, cumulative = self._table(low)
+        # Choose the kernels.
+        u = np.random.random(n) * cumulative[-1]
+        idx = np.searchsorted(cumulative, u, side='right')
+        idx = np.minimum(idx, len(cumulative) - 1)
+        c = self.centers[idx]
+        # Sample each kernel above the bound.
+        v = 1.0 - np.random.random(n)
+        if self.kernel == 'gaussian':
+            from scipy.special import ndtri
+            x = c - self.bandwidth * ndtri(v * mass[idx])
+        else:
+            start = np.maximum(c - self.bandwidth, low)
+            x = c + self.bandwidth - v * (c + self.bandwidth - start)
+        samples = np.maximum(x, low).astype(int)
+        if min_value is not None:
+            samples = np.maximum(samples, min_value)
+
+        return samples
+
+    def _table(self, low):
+        """Returns the mass of each kernel above low, and the
+        cumulative (unnormalised) mass of the truncated mixture.
+        """
+        # A single lookup: another thread may clear the tables.
+        table = self._tables.get(low)
+        if table is not None:
+            return table
+        if self.kernel == 'gaussian':
+            # scipy is slow to import: only truncated gaussians need it.
+            from scipy.special import ndtr
+            mass = ndtr((self.centers - low) / self.bandwidth)
+        else:
+            mass = (self.centers + self.bandwidth - low) / (2*self.bandwidth)
+            mass = np.clip(mass, 0., 1.)
+        cumulative = np.cumsum(self.weights * mass)
+        if cumulative[-1] < self.min_mass:
+            raise Exception('The distribution has (almost) no mass above ' +
+                            '{} (mass: {}).'.format(low, cumulative[-1]))
+        # Bound the memory used by the tables.
+        if len(self._tables) >= 256:
+            self._tables.clear()
+        self._tables[low] = (mass, cumulative)
+
+        return mass, cumulative
+
+class KDETruncated(PageSampler):
+    """Samples from KDEs truncated at the minimum values.
+
+    Same distribution as KDEIndividual, but the truncated
+    distributions are sampled directly (see TruncatedKDE) rather
+    than by rejection, which bounds the sampling time and fails
+    when a minimum value is beyond the support of a distribution.
+    """
+
+    def __init__(self, file_count, file_html, file_objs, random_state=0):
+        super(self.__class__, self).__init__(random_state)
+
+        self.count_kde = self.read_kde(file_count)
+        self.html_kde = self.read_kde(file_html)
+        self.objs_kde = self.read_kde(file_objs)
+
+    def sample_page(self, min_count=0, min_html=0, min_objs=0):
+        """Samples html_size and size of objects objs_size.
+        
+        Parameters
+        ----------
+        min_count : int
+            Minimum number of objects.
+        min_html : int
+            Minimum size of HTML page.
+        min_objs : int
+            Minimum size of an object.
+
+        Returns
+        -------
+        html_size : int
+            Size of HTML.
+        objs_size : list of int
+            Size of each object.
+        """
+        count = int(self.count_kde.sample(1, min_count)[0])
+        html_size = int(self.html_kde.sample(1, min_html)[0])
+        objs_size = self.objs_kde.sample(count, min_objs)
+
+        return html_size, [int(x) for x in objs_size]
+
+    def read_kde(self, fname):
+        return TruncatedKDE.from_kde(read_kde(fname))
 
 class KDEMultivariate(PageSampler):
 
@@ -110,20 +329,32 @@ class KDEMultivariate(PageSampler):
         return html_size, objs_size
 
     def read_kde(self, fname):
-        with open(fname, 'rb') as f:
-            return pickle.load(f)
+        return read_kde(fname)
 
 
 class Histogram(PageSampler):
+    """Samples from histograms.
+
+    Each histogram is loaded once into arrays of values, in
+    increasing order, and of cumulative probabilities. Sampling
+    values that are at least a lower bound finds the mass below the
+    bound by binary search, and maps uniforms drawn above it onto the
+    values by binary search on the cumulative table: a draw costs
+    O(log n), and nothing proportional to the size of the histogram
+    is allocated.
+    """
 
     def __init__(self, file_count, file_html, file_objs, random_state=0):
         super(self.__class__, self).__init__(random_state)
 
-        self.count_hist = self.read_distribution(file_count)
-        self.html_hist = self.read_distribution(file_html)
-        self.objs_hist = self.read_distribution(file_objs)
+        self.count_hist = self.cumulative_table(
+                                *self.read_distribution(file_count))
+        self.html_hist = self.cumulative_table(
+                                *self.read_distribution(file_html))
+        self.objs_hist = self.cumulative_table(
+                                *self.read_distribution(file_objs))
         
-    def sample_page(self, min_count=None, min_html=None, min_objs=None):
+    def sample_page(self, min_count=0, min_html=0, min_objs=0):
         """Samples html_size and size of objects objs_size.
         
         Parameters
@@ -142,32 +373,14 @@ class Histogram(PageSampler):
         objs_size : list of int
             Size of each object.
         """
-        # Count.
-        if min_count:
-            count_hist = self.remove_smaller_than(self.count_hist[0],
-                                                  self.count_hist[1],
-                                                  min_count)
-        else:
-            count_hist = self.count_hist
-        count = self.sample_distribution(*count_hist)
-        # HTML.
-        if min_html:
-            html_hist = self.remove_smaller_than(self.html_hist[0],
-                                                 self.html_hist[1],
-                                                 min_html)
-        else:
-            html_hist = self.html_hist
-        html_s = self.sample_distribution(*html_hist)
-        # Objects.
-        if min_objs:
-            objs_hist = self.remove_smaller_than(self.objs_hist[0],
-                                                 self.objs_hist[1],
-                                                 min_objs)
-        else:
-            objs_hist = self.objs_hist
-        objs_s = self.sample_distribution(size=count, *objs_hist)
+        count = int(self.sample_distribution(min_val=min_count,
+                                             *self.count_hist)[0])
+        html_s = int(self.sample_distribution(min_val=min_html,
+                                              *self.html_hist)[0])
+        objs_s = self.sample_distribution(size=count, min_val=min_objs,
+                                          *self.objs_hist)
     
-        return html_s, objs_s
+        return html_s, objs_s.tolist()
 
     def read_distribution(self, fname):
         """Read a histogram distribution file ".his".
@@ -185,86 +398,267 @@ class Histogram(PageSampler):
     
         Return
         ------
-        values : list of int
-            List of possible values.
-        probabilities : list of float
+        values : array of int
+            Possible values, in increasing order.
+        probabilities : array of float
             Probabilities associated with the values.
             sum(probabilities) = 1.0.
         """
-        with open(fname, 'r') as f:
-            entries = f.read().strip().split('\n')
+        values, probabilities = np.loadtxt(fname, ndmin=2, unpack=True)
+        values = values.astype(int)
     
-        values = []
-        probabilities = []
-        for e in entries:
-            v, p = e.split(' ')
-            values.append(int(v))
-            probabilities.append(float(p))
-    
-        if not np.isclose(sum(probabilities), 1.0):
+        if not np.isclose(probabilities.sum(), 1.0):
             raise Exception("Corrupted distribution file: probabilities do not " +
                             "sum up to 1.")
+        order = np.argsort(values, kind='mergesort')
         
-        return values, probabilities
+        return values[order], probabilities[order]
+
+    def cumulative_table(self, values, probabilities):
+        """Returns the values of a histogram, and the cumulative
+        probability of each of them.
+
+        Parameters
+        ----------
+        values : array of int
+            Possible values, in increasing order.
+        probabilities : array of float
+            Occurrence probabilities of each value.
+
+        Return
+        ------
+        values : array of int
+            Possible values, in increasing order.
+        cumulative : array of float
+            cumulative[i] = sum(probabilities[:i+1]).
+        """
+        if len(values) != len(probabilities):
+            raise Exception('The size of values must be equal to the size of probabilities.')
+
+        return values, np.cumsum(probabilities)
     
-    def sample_distribution(self, values, probabilities, size=1, min_val=None):
+    def sample_distribution(self, values, cumulative, size=1, min_val=None):
         """Sample from histogram with replacement.
     
-        The histogram is specified by a list of values, and the
-        respective probabilities.
+        The histogram is specified by its values, in increasing
+        order, and their cumulative probabilities (see
+        cumulative_table).
         Size represents the sample size.
         Returns an array of values.
     
         Parameters
         ----------
-        values : list
-            List of the values that can be taken.
-        probabilities : list of float
-            Occurrence probabilities of each value.
+        values : array of int
+            Values that can be taken, in increasing order.
+        cumulative : array of float
+            Cumulative probability of each value.
         size : int (Default: 1)
             Sample size.
         min_val : int (Default: None)
-            If specified, the sampled value is at least min_val.
+            If specified, the sampled values are at least min_val.
     
         Return
         ------
         value : array of values
             Array of values of size size.
         """
-        if len(values) != len(probabilities):
-            raise Exception('The size of values must be equal to the size of probabilities.')
-        
-        return np.random.choice(values, size=size, replace=True, p=probabilities)
-    
-    def remove_smaller_than(self, values, probabilities, value):
-        """Removes from an histogram all the values smaller than value.
-    
-        Normalises the resulting histogram, and returns it.
+        # Mass of the values smaller than min_val.
+        low = 0.
+        if min_val is not None:
+            i = np.searchsorted(values, min_val, side='left')
+            if i > 0:
+                low = cumulative[i-1]
+        mass = cumulative[-1] - low
+        if mass <= 0:
+            raise Exception('The histogram has no mass at or above {}.'.format(
+                                min_val))
+        u = low + np.random.random(size) * mass
+        idx = np.searchsorted(cumulative, u, side='right')
+        # Rounding may put u at the very end of the table.
+        idx = np.minimum(idx, len(cumulative) - 1)
     
+        return values[idx]
+
+class PooledSampler(PageSampler):
+    """Serves pages from pools of pre-drawn samples.
+
+    Wraps a PageSampler, and keeps a bounded pool of pages for each
+    set of constraints (min_count, min_html, min_objs) it is asked
+    for. Pools are refilled by a background thread when they drop
+    below low_water, so that sampling a page is a dictionary lookup.
+    Pools are keyed by the full set of constraints, so that pooled
+    pages follow exactly the distribution of the wrapped sampler
+    (filtering a shared pool by constraint would bias the count of
+    objects towards smaller values).
+
+    Parameters
+    ----------
+    sampler : PageSampler
+        Sampler used to fill the pools.
+    pool_size : int (Default: 64)
+        Number of pages kept in each pool.
+    low_water : int (Default: 16)
+        A pool is refilled when it has fewer pages than this.
+    max_pools : int (Default: 1024)
+        Maximum number of pools; the least recently used one is
+        dropped when a new one is needed.
+    background : bool (Default: True)
+        Refill pools in a background thread. If False, pools are
+        only refilled when refill() is called.
+    """
+
+    def __init__(self, sampler, pool_size=64, low_water=16, max_pools=1024,
+                 background=True):
+        self.sampler = sampler
+        self.pool_size = pool_size
+        self.low_water = low_water
+        self.max_pools = max_pools
+        # Metrics.
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refilled = 0
+
+        self._pools = OrderedDict()
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._sampler_lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._refill_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def sample_page(self, min_count=0, min_html=0, min_objs=0):
+        """Samples html_size and size of objects objs_size.
+
         Parameters
         ----------
-        values : list
-            List of the values that can be taken.
-        probabilities : list of float
-            Occurrence probabilities of each value.
-        value : int
-            Smallest value allowed.
-        
-        Return
-        ------
-        values : list of int
-            List of possible values.
-        probabilities : list of float
-            Probabilities associated with the values.
-            sum(probabilities) = 1.0.
+        min_count : int
+            Minimum number of objects.
+        min_html : int
+            Minimum size of HTML page.
+        min_objs : int
+            Minimum size of an object.
+
+        Returns
+        -------
+        html_size : int
+            Size of HTML.
+        objs_size : list of int
+            Size of each object.
         """
-        new_v = []
-        new_p = []
-        for i, v in enumerate(values):
-            if v >= value:
-                new_v.append(v)
-                new_p.append(probabilities[i])
-        
-        new_p = np.array(new_p) / sum(new_p)
-    
-        return new_v, list(new_p)
+        key = (min_count, min_html, min_objs)
+        page = None
+        with self._cond:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = deque()
+                self._pools[key] = pool
+                if len(self._pools) > self.max_pools:
+                    self._pools.popitem(last=False)
+            else:
+                # Mark as recently used.
+                del self._pools[key]
+                self._pools[key] = pool
+            if pool:
+                page = pool.popleft()
+                self.hits += 1
+            else:
+                self.misses += 1
+            if len(pool) < self.low_water and key not in self._pending:
+                self._pending.append(key)
+                self._cond.notify()
+        if page is None:
+            page = self._sample(key)
+
+        return page
+
+    def refill(self):
+        """Refills all the pools that are below low_water.
+        """
+        while True:
+            with self._cond:
+                if not self._pending:
+                    return
+                key = self._pending.popleft()
+            self._refill(key)
+
+    def stats(self):
+        """Returns pool metrics.
+
+        Returns
+        -------
+        stats : dict
+            Pool hits and misses, number of refills and of pages
+            drawn by refills, number of pools and of pooled pages.
+        """
+        with self._cond:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'refills': self.refills,
+                    'refilled': self.refilled,
+                    'pools': len(self._pools),
+                    'pooled': sum(len(p) for p in self._pools.values())}
+
+    def close(self):
+        """Stops the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _sample(self, key):
+        with self._sampler_lock:
+            return self.sampler.sample_page(*key)
+
+    def _refill(self, key):
+        with self._cond:
+            pool = self._pools.get(key)
+            if pool is None:
+                return
+            missing = self.pool_size - len(pool)
+        pages = [self._sample(key) for i in range(missing)]
+        with self._cond:
+            # The pool may have been dropped meanwhile.
+            if self._pools.get(key) is pool:
+                pool.extend(pages)
+            self.refills += 1
+            self.refilled += len(pages)
+
+    def _refill_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                key = self._pending.popleft()
+            self._refill(key)
+
+# Samplers of the distribution types, by name.
+SAMPLERS = {'histogram': Histogram,
+            'kde': KDEIndividual,
+            'kde-truncated': KDETruncated}
+
+def make_sampler(distribution_type, file_count, file_html, file_objs):
+    """Returns a PageSampler of the given distribution type.
+
+    Parameters
+    ----------
+    distribution_type : str
+        One of SAMPLERS ('histogram', 'kde', 'kde-truncated').
+    file_count : str
+        Distribution of the number of objects.
+    file_html : str
+        Distribution of the size of the HTML page.
+    file_objs : str
+        Distribution of the size of the objects.
+    """
+    if distribution_type not in SAMPLERS:
+        raise Exception("{} not recognised.".format(distribution_type))
+
+    return SAMPLERS[distribution_type](file_count, file_html, file_objs)
@@ -0,0 +1,324 @@
+"""Morphing service.
+
+A long-running HTTP server accepting morph jobs, so that the
+interpreter start-up and the loading of the distributions are
+paid once rather than for each page.
+
+Jobs are POSTed to /morph as JSON objects:
+
+    {"page": "www/index.html", "dst": "out/", "method": "distribution"}
+    {"page": ..., "dst": ..., "method": "deterministic",
+     "S": 5000, "L": 5, "maxs": 100000}
+    {"page": ..., "dst": ..., "method": "target",
+     "html_size": 12000, "sizes": [3000, 45000]}
+
+and the reply describes the morphed page. Pages are read from
+--root, and written into --dst-root (both default to the current
+directory): jobs reading or writing elsewhere are refused. GET
+/stats returns the
+counters of the server, the timings and counters of morphing (see
+metrics) and, with --pool-size, the metrics of the sampler pools
+(see sampling.PooledSampler).
+
+    python server.py --port 8080 --distribution-type kde --count-dist counts.npz --html-dist html.npz --objects-dist html.npz
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import metrics
+import morphing
+import sampling
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger(__name__)
+
+class MorphServer(ThreadingMixIn, HTTPServer):
+    """HTTP server morphing pages, one thread per request.
+
+    At most max_jobs jobs are run at the same time. A job waits
+    at most wait seconds for a free slot, after which it is refused
+    (503), so that clients back off instead of piling up.
+
+    Parameters
+    ----------
+    address : (str, int)
+        Address the server listens on.
+    page_sampler : sampling.PageSampler
+        Sampler of the 'distribution' jobs (None to refuse them).
+    max_jobs : int (Default: 4)
+        Maximum number of jobs run concurrently.
+    wait : float (Default: 10)
+        Time (in seconds) a job waits for a free slot.
+    workers : int (Default: 1)
+        Number of objects morphed in parallel for each job.
+    processes : bool (Default: False)
+        Morph objects in a pool of processes rather than threads.
+    root : str (Default: '.')
+        Directory of the pages (and of their objects) jobs may morph.
+        Also the document root of paths starting with '/'.
+    dst_root : str (Default: '.')
+        Directory jobs may write morphed pages into.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, page_sampler, max_jobs=4, wait=10,
+                 workers=1, processes=False, root=os.curdir,
+                 dst_root=os.curdir):
+        HTTPServer.__init__(self, address, MorphHandler)
+        self.page_sampler = page_sampler
+        self.root = os.path.realpath(root)
+        self.dst_root = os.path.realpath(dst_root)
+        self.wait = wait
+        self.workers = workers
+        self.processes = processes
+        self.max_jobs = max_jobs
+        # Number of jobs running, and condition notified when one ends.
+        self.running = 0
+        self._slots = threading.Condition()
+        # Metrics.
+        self.done = 0
+        self.failed = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for a free slot. Returns False if none got free
+        within self.wait seconds.
+        """
+        deadline = time.time() + self.wait
+        with self._slots:
+            while self.running >= self.max_jobs:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+            self.running += 1
+        return True
+
+    def release(self):
+        with self._slots:
+            self.running -= 1
+            self._slots.notify()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._lock:
+            stats = {'done': self.done,
+                     'failed': self.failed,
+                     'refused': self.refused}
+        recorder = metrics.get_metrics()
+        if isinstance(recorder, metrics.Recorder):
+            stats.update(recorder.snapshot())
+        # Hits, misses and refills of a PooledSampler.
+        if hasattr(self.page_sampler, 'stats'):
+            stats['pool'] = self.page_sampler.stats()
+
+        return stats
+
+    def plan(self, job):
+        """Plans a job.
+        """
+        method = job.get('method')
+        page = job['page']
+        if method == 'distribution':
+            if self.page_sampler is None:
+                raise ValueError('No distribution loaded.')
+            return morphing.plan_page_distribution(page, self.page_sampler,
+                                                   root=self.root)
+        elif method == 'deterministic':
+            S = _int(job['S'], 'S')
+            L = _int(job['L'], 'L')
+            maxs = _int(job['maxs'], 'maxs')
+            if maxs % S != 0:
+                raise ValueError('maxs should be a multiple of S.')
+            return morphing.plan_page_deterministic(page, S, L, maxs,
+                                                    root=self.root)
+        elif method == 'target':
+            html_size = _int(job['html_size'], 'html_size')
+            sizes = job['sizes']
+            if not isinstance(sizes, list):
+                raise ValueError('sizes must be a list of integers.')
+            sizes = [_int(x, 'Each size') for x in sizes]
+            return morphing.plan_page_target(page, html_size, sizes,
+                                             root=self.root)
+        raise ValueError('Unknown method {}.'.format(method))
+
+    def run(self, job):
+        """Runs a job, and returns the description of the morphed page.
+        """
+        start = time.time()
+        job = dict(job, page=_path(job, 'page'), dst=_path(job, 'dst'))
+        if not _inside(job['page'], self.root):
+            raise ValueError('The page is outside the root.')
+        if not os.path.isfile(job['page']):
+            raise ValueError('No such page.')
+        plan = self.plan(job)
+        # Objects may be referenced from outside the root (../).
+        for source in plan.sources:
+            if not _inside(source, self.root):
+                raise ValueError('{} is outside the root.'.format(source))
+        for path in [os.path.basename(plan.fname)] + list(plan.paths) + \
+                plan.padding_paths():
+            if not _inside(os.path.join(job['dst'], path), self.dst_root):
+                raise ValueError('{} is outside the destination root.'.format(
+                                 path))
+        morphing.execute_plan(plan, job['dst'], self.workers, self.processes)
+
+        return {'page': job['page'],
+                'dst': job['dst'],
+                'html_size': plan.target_html_size,
+                'sizes': plan.sizes.tolist(),
+                'padding': plan.padding.tolist(),
+                'seconds': time.time() - start}
+
+def _int(value, name, minimum=1):
+    """Returns value, which must be an integer of at least minimum.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, long)):
+        raise ValueError('{} must be an integer.'.format(name))
+    if value < minimum:
+        raise ValueError('{} must be at least {}.'.format(name, minimum))
+    return value
+
+def _path(job, key):
+    """Returns job[key], which must be a path, as a byte string.
+    """
+    value = job[key]
+    if not isinstance(value, basestring):
+        raise ValueError('{} must be a path.'.format(key))
+    if isinstance(value, unicode):
+        value = value.encode(sys.getfilesystemencoding() or 'utf-8')
+    return value
+
+def _inside(path, root):
+    """Returns True if path (resolved) is root or inside root.
+    """
+    path = os.path.realpath(path)
+
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+class MorphHandler(BaseHTTPRequestHandler):
+    """Handles the requests of a MorphServer.
+    """
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.stats())
+        else:
+            self._reply(404, {'error': 'Not found.'})
+
+    def do_POST(self):
+        if self.path != '/morph':
+            self._reply(404, {'error': 'Not found.'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = json.loads(self.rfile.read(length))
+            if not isinstance(job, dict):
+                raise ValueError('A job must be a JSON object.')
+            if 'page' not in job or 'dst' not in job:
+                raise ValueError('A job needs a page and a dst.')
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+            return
+
+        if not self.server.acquire():
+            self.server.count('refused')
+            self._reply(503, {'error': 'Too many jobs.'},
+                        [('Retry-After', '1')])
+            return
+        try:
+            result = self.server.run(job)
+        except (ValueError, KeyError) as e:
+            self.server.count('failed')
+            self._reply(400, {'error': str(e)})
+        except morphing.MorphingError as e:
+            # The page does not fit into the target sizes.
+            self.server.count('failed')
+            self._reply(422, {'error': str(e)})
+        except Exception as e:
+            self.server.count('failed')
+            self._reply(500, {'error': str(e)})
+        else:
+            self.server.count('done')
+            self._reply(200, result)
+        finally:
+            self.server.release()
+
+    def log_message(self, format, *args):
+        logger.info('%s %s', self.client_address[0], format % args)
+
+    def _reply(self, code, content, headers=()):
+        body = json.dumps(content)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description='Morphing service.')
+
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on.')
+    parser.add_argument('--root', type=str, default=os.curdir,
+                        help='Directory of the pages jobs may morph.')
+    parser.add_argument('--dst-root', type=str, default=os.curdir,
+                        help='Directory jobs may write morphed pages into.')
+    parser.add_argument('--max-jobs', type=int, default=4,
+                        help='Maximum number of jobs run concurrently.')
+    parser.add_argument('--wait', type=float, default=10,
+                        help='Seconds a job waits for a free slot before ' +
+                             'being refused.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of objects morphed in parallel.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Morph objects in processes rather than threads.')
+    parser.add_argument('--distribution-type', type=str,
+                        help='Histograms or KDE.',
+                        choices=['histogram', 'kde', 'kde-truncated'])
+    parser.add_argument('--count-dist', type=str,
+                        help='Sample number of objects from distribution file.')
+    parser.add_argument('--html-dist', type=str,
+                        help='Sample HTML size from distribution file.')
+    parser.add_argument('--objects-dist', type=str,
+                        help='Sample sizes from distribution file.')
+    parser.add_argument('--pool-size', type=int, default=0,
+                        help='Serve samples from pools of this size ' +
+                             '(see sampling.PooledSampler).')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Level of the messages logged.')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    metrics.set_metrics(metrics.Recorder())
+    dist = None
+    if args.distribution_type:
+        dist = sampling.make_sampler(args.distribution_type, args.count_dist,
+                                     args.html_dist, args.objects_dist)
+        if args.pool_size > 0:
+            dist = sampling.PooledSampler(dist, args.pool_size,
+                                          args.pool_size // 4)
+
+    server = MorphServer((args.host, args.port), dist, args.max_jobs,
+                         args.wait, args.workers, args.processes, args.root,
+                         args.dst_root)
+    logger.info('Listening on %s:%d', args.host, args.port)
+    server.serve_forever()
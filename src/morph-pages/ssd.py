@@ -1,17 +1,58 @@
-import page
-import morphing
-import sampling
+# Modules needed by a method are imported in its branch (numpy,
+# scipy, PIL... are slow to import), so that morphing a single page
+# only pays for what it uses.
+import time
+import json
+import logging
+import metrics
 from argparse import ArgumentParser
 
+def add_distribution_arguments(parser):
+    parser.add_argument('--distribution-type', type=str,
+                        help='Histograms or KDE.',
+                        choices=['histogram', 'kde', 'kde-truncated'],
+                        required=True)
+    parser.add_argument('--count-dist', type=str,
+                        help='Sample number of objects from distribution file.',
+                        required=True)
+    parser.add_argument('--html-dist', type=str,
+                        help='Sample HTML size from distribution file.', required=True)
+    parser.add_argument('--objects-dist', type=str,
+                        help='Sample sizes from distribution file.', required=True)
+
+def add_deterministic_arguments(parser):
+    parser.add_argument('--S', type=int,
+                        help='The size of each object is padded to the next' +
+                             'multiple of S.', required=True)
+    parser.add_argument('--L', type=int,
+                        help='The number of objects is padded to the next' +
+                             'multiple of L.', required=True)
+    parser.add_argument('--maxs', type=int,
+                        help='The maximum size of new objects (must be a ' +
+                             'multiple of S.', required=True)
+    parser.add_argument('--padding-pool', type=str,
+                        help='Directory of a pool of random blobs, which ' +
+                             'new objects are hard links to.')
 
 if __name__ == '__main__':
     
     parser = ArgumentParser(description='Server side defence.')
 
-    parser.add_argument('--page', type=str, help='Page to morph.',
-                        required=True)
-    parser.add_argument('--dst', type=str, help='Destination html file.',
+    parser.add_argument('--page', type=str,
+                        help='Page to morph (all methods but batch).')
+    parser.add_argument('--dst', type=str, help='Destination directory.',
                         required=True)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of objects morphed in parallel.')
+    parser.add_argument('--processes', action='store_true',
+                        help='Morph objects in processes rather than threads.')
+    parser.add_argument('--log-level', type=str, default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='Level of the messages logged (DEBUG: one ' +
+                             'message per object).')
+    parser.add_argument('--metrics', action='store_true',
+                        help='Log the time spent in each stage, and ' +
+                             'counters (bytes padded, retries, ...).')
     subparsers = parser.add_subparsers(help='Methods', dest='method')
 
     # Morph to target mode.
@@ -24,28 +65,11 @@ if __name__ == '__main__':
     # Morph according to distribution.
     parser_distribution = subparsers.add_parser('distribution',
                         help='Morph according to distribution.')
-    parser_distribution.add_argument('--distribution-type', type=str,
-                        help='Histograms or KDE.', choices=['histogram', 'kde'],
-                        required=True)
-    parser_distribution.add_argument('--count-dist', type=str,
-                        help='Sample number of objects from distribution file.',
-                        required=True)
-    parser_distribution.add_argument('--html-dist', type=str,
-                        help='Sample HTML size from distribution file.', required=True)
-    parser_distribution.add_argument('--objects-dist', type=str,
-                        help='Sample sizes from distribution file.', required=True)
+    add_distribution_arguments(parser_distribution)
     # Morph deterministically.
     parser_deterministic = subparsers.add_parser('deterministic',
                         help='Morph to multiples of S and L.')
-    parser_deterministic.add_argument('--S', type=int,
-                        help='The size of each object is padded to the next' +
-                             'multiple of S.', required=True)
-    parser_deterministic.add_argument('--L', type=int,
-                        help='The number of objects is padded to the next' +
-                             'multiple of L.', required=True)
-    parser_deterministic.add_argument('--maxs', type=int,
-                        help='The maximum size of new objects (must be a ' +
-                             'multiple of S.', required=True)
+    add_deterministic_arguments(parser_deterministic)
     # Morph with respect to size file.
     parser_file = subparsers.add_parser('file',
                     help='Morph with respect to the given size file.')
@@ -53,30 +77,101 @@ if __name__ == '__main__':
                         help='File containing the target size of the html page,' +
                              'and the size of the objects line by line.',
                         required=True)
+    # Morph all the pages of a site.
+    parser_batch = subparsers.add_parser('batch',
+                    help='Morph all the pages of a site.')
+    parser_batch.add_argument('--src', type=str,
+                        help='Directory of the site (document root).',
+                        required=True)
+    parser_batch.add_argument('--manifest', type=str,
+                        help='File listing the pages to morph (relative to ' +
+                             '--src), one per line. Default: all the HTML ' +
+                             'files in --src.')
+    parser_batch.add_argument('--jobs', type=int, default=1,
+                        help='Number of pages morphed in parallel.')
+    parser_batch.add_argument('--chunksize', type=int, default=8,
+                        help='Number of pages handed to a process at once.')
+    parser_batch.add_argument('--incremental', action='store_true',
+                        help='Only morph the pages that changed since the ' +
+                             'previous incremental run.')
+    parser_batch.add_argument('--watch', type=float,
+                        help='Morph incrementally every WATCH seconds, ' +
+                             'forever.')
+    parser_batch.add_argument('--in-place', action='store_true',
+                        help='Morph objects in place rather than into ' +
+                             'content-addressed variants.')
+    batch_subparsers = parser_batch.add_subparsers(help='Methods',
+                                                   dest='batch_method')
+    add_distribution_arguments(batch_subparsers.add_parser('distribution',
+                        help='Morph according to distribution.'))
+    add_deterministic_arguments(batch_subparsers.add_parser('deterministic',
+                        help='Morph to multiples of S and L.'))
 
     args = parser.parse_args()
+    if args.method != 'batch' and args.page is None:
+        parser.error('--page is required by method {}.'.format(args.method))
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+    if args.metrics:
+        recorder = metrics.Recorder()
+        metrics.set_metrics(recorder)
 
     if args.method == 'target':
+        import page
+        import morphing
         target = page.Page(args.target_page)
         html_size = target.html['size']
         obj_sizes = target.get_sizes()
-        morphing.morph_page_target(args.page, html_size, obj_sizes, args.dst)
+        morphing.morph_page_target(args.page, html_size, obj_sizes, args.dst,
+                                   args.workers, args.processes)
     elif args.method == 'distribution':
-        if args.distribution_type == 'histogram':
-            dist = sampling.Histogram(args.count_dist, args.html_dist,
-                                      args.objects_dist)
-        elif args.distribution_type == 'kde':
-            dist = sampling.KDEIndividual(args.count_dist, args.html_dist,
-                                          args.objects_dist)
-        else:
-            raise Exception("{} not recognised.".format(args.distribution_type))
-        morphing.morph_page_distribution(args.page, dist, args.dst)
+        import morphing
+        import sampling
+        dist = sampling.make_sampler(args.distribution_type, args.count_dist,
+                                     args.html_dist, args.objects_dist)
+        morphing.morph_page_distribution(args.page, dist, args.dst,
+                                         args.workers, args.processes)
     elif args.method == 'deterministic':
+        import morphing
         morphing.morph_page_deterministic(args.page, args.S, args.L, args.maxs,
-                                          args.dst)
+                                          args.dst, args.workers,
+                                          args.processes,
+                                          padding_pool=args.padding_pool)
     elif args.method == 'file':
+        import morphing
         with open(args.target_file, 'r') as f:
             sizes = f.read().strip().split()
         html_size = int(sizes[0])
         obj_sizes = [int(x) for x in sizes[1:]]
-        morphing.morph_page_target(args.page, html_size, obj_sizes, args.dst)
+        morphing.morph_page_target(args.page, html_size, obj_sizes, args.dst,
+                                   args.workers, args.processes)
+    elif args.method == 'batch':
+        import batch
+        if args.manifest:
+            find = lambda: batch.read_manifest(args.manifest, args.src)
+        else:
+            find = lambda: batch.find_pages(args.src)
+        distribution = None
+        params = {}
+        padding_pool = None
+        if args.batch_method == 'distribution':
+            distribution = (args.distribution_type, args.count_dist,
+                            args.html_dist, args.objects_dist)
+        else:
+            params = {'S': args.S, 'L': args.L, 'max_S': args.maxs}
+            padding_pool = args.padding_pool
+        if args.watch:
+            batch.watch(find, args.src, args.dst, args.batch_method, params,
+                        distribution, args.watch, processes=args.jobs,
+                        chunksize=args.chunksize, workers=args.workers,
+                        variants=not args.in_place, padding_pool=padding_pool)
+        start = time.time()
+        results = batch.morph_site(find(), args.src, args.dst,
+                                   args.batch_method, params, distribution,
+                                   args.jobs, args.chunksize, args.workers,
+                                   not args.in_place, padding_pool,
+                                   args.incremental)
+        batch.report(results, time.time() - start)
+
+    if args.metrics:
+        logging.info('Metrics: %s', json.dumps(recorder.snapshot(),
+                                               sort_keys=True))